@@ -7,13 +7,16 @@ from datetime import datetime, timedelta
 from .filters import AdminFilter
 from ..bot.db.postgres import db
 from ..bot.services.openai_service import ask_gpt
+from ..bot.services.llm_scheduler import PRIORITY_PREMIUM
 from ..bot.services.mailing_service import send_mailing
+from ..bot.services.config_cache import publish_invalidation, PROMPT, PRICES, TEXT_SETTINGS
 from ..bot.utils.csv_export import export_users_csv
+from ..bot.services.stats_service import get_stats, stats_today
+from ..bot.services.response_cache import purge_response_cache, get_cache_stats
 from ..bot.config import settings
 from aiogram import Bot
 import io
 import re
-import tempfile
 import os
 
 # --- FSM ---
@@ -91,6 +94,8 @@ async def save_full_prompt(message: Message, state: FSMContext):
     text = "\n\n".join(parts)
     await db.execute("UPDATE prompts SET is_active=FALSE")
     await db.execute("INSERT INTO prompts (text, is_active) VALUES ($1, TRUE)", text)
+    await publish_invalidation(PROMPT)
+    await purge_response_cache()
     await message.answer("Промпт обновлён и активирован.", reply_markup=ReplyKeyboardRemove())
     await state.clear()
 
@@ -125,6 +130,8 @@ async def restore_prompt(message: Message):
         return
     await db.execute("UPDATE prompts SET is_active=FALSE")
     await db.execute("INSERT INTO prompts (text, is_active) VALUES ($1, TRUE)", row['text'])
+    await publish_invalidation(PROMPT)
+    await purge_response_cache()
     await message.answer("Промпт восстановлен и активирован.")
 
 # --- Рассылка ---
@@ -188,34 +195,53 @@ async def mailing_segment_callback(call, state: FSMContext):
 # --- Статистика ---
 @router.message(AdminFilter(), Command("stats"))
 async def stats(message: Message):
-    row = await db.fetchrow("SELECT COUNT(*) AS count FROM users")
-    total = row["count"] if row else 0
-    row = await db.fetchrow("SELECT COUNT(*) AS count FROM users WHERE status='premium'")
-    premium = row["count"] if row else 0
-    row = await db.fetchrow("SELECT COUNT(*) AS count FROM users WHERE last_activity > $1", datetime.now() - timedelta(days=7))
-    active_7d = row["count"] if row else 0
-    row = await db.fetchrow("SELECT AVG(cnt) AS avg_cnt FROM (SELECT COUNT(*) as cnt FROM messages GROUP BY user_id) t")
-    avg_dialog = row["avg_cnt"] if row else 0
-    row = await db.fetchrow("SELECT COUNT(*) AS count FROM payments WHERE created_at::date = CURRENT_DATE AND status='success'")
-    payments_today = row["count"] if row else 0
+    # Агрегаты заранее посчитаны в daily_stats основным ботом — здесь один запрос
+    rows = await get_stats(days=7)
+    if not rows:
+        await message.answer("Статистика пока недоступна.")
+        return
+    snapshot = next((r for r in rows if r["total_users"] is not None), rows[0])
+    dialog_users = snapshot["dialog_users"] or 0
+    avg_dialog = rows[0]["messages_total"] / dialog_users if dialog_users else 0
+    # Строки за сегодня может не быть, если пересчет не удался — тогда оплат сегодня 0
+    today_payments = rows[0]["payments"] if rows[0]["day"] == stats_today() else 0
+    cache = await get_cache_stats()
+
+    history = "\n".join(
+        f"{r['day'].strftime('%d.%m')}: DAU {r['dau']}, сообщений {r['messages']}, "
+        f"оплат {r['payments']} ({r['revenue_xtr']:g} XTR / {r['revenue_rub']:g} RUB)"
+        for r in rows
+    )
     await message.answer(
         f"{hbold('Статистика')}\n"
-        f"Всего пользователей: {total}\n"
-        f"Подписчиков: {premium}\n"
-        f"Средняя длина диалога: {round(avg_dialog, 1) if avg_dialog is not None else 0}\n"
-        f"Активные за 7 дней: {active_7d}\n"
-        f"Оплаты сегодня: {payments_today}"
+        f"Всего пользователей: {snapshot['total_users'] or 0}\n"
+        f"Подписчиков: {snapshot['premium_users'] or 0}\n"
+        f"Средняя длина диалога: {round(avg_dialog, 1)}\n"
+        f"Активные за 7 дней: {snapshot['active_7d'] or 0}\n"
+        f"Оплаты сегодня: {today_payments}\n"
+        f"Кэш ответов GPT: попаданий {cache['hits']}, промахов {cache['misses']}, записей {cache['entries']}\n\n"
+        f"{hbold('По дням')}\n{history}\n\n"
+        f"Обновлено: {rows[0]['updated_at'].strftime('%d.%m.%Y %H:%M')}"
     )
 
 @router.message(AdminFilter(), Command("download_csv"))
-async def download_csv(message: Message):
-    csv_bytes = await export_users_csv()
-    # Сохраняем во временный файл для передачи через FSInputFile
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp:
-        tmp.write(csv_bytes)
-        tmp_path = tmp.name
+async def download_csv(message: Message, command: CommandObject):
+    # Необязательные фильтры: /download_csv status=premium from=2025-01-01 to=2025-01-31
+    filters = {}
+    for arg in (command.args or "").split():
+        key, _, value = arg.partition("=")
+        filters[key] = value
+    try:
+        date_from = datetime.strptime(filters["from"], "%Y-%m-%d").date() if filters.get("from") else None
+        date_to = datetime.strptime(filters["to"], "%Y-%m-%d").date() if filters.get("to") else None
+    except ValueError:
+        await message.answer("Неверный формат даты. Пример: /download_csv status=premium from=2025-01-01 to=2025-01-31")
+        return
+
+    # Выгрузка пишется потоком сразу во временный gzip-файл
+    tmp_path = await export_users_csv(status=filters.get("status"), date_from=date_from, date_to=date_to)
     try:
-        file = FSInputFile(tmp_path, filename="users.csv")
+        file = FSInputFile(tmp_path, filename="users.csv.gz")
         await message.answer_document(file)
     finally:
         os.remove(tmp_path)
@@ -287,7 +313,8 @@ async def process_test_prompt(message: Message, state: FSMContext):
     prompt_row = await db.fetchrow("SELECT text FROM prompts WHERE is_active=TRUE ORDER BY id DESC LIMIT 1")
     system_prompt = prompt_row["text"] if prompt_row else ""
     # Отправляем запрос к OpenAI
-    reply = await ask_gpt(system_prompt, history=[{"role": "user", "content": user_input}])
+    # Повторный прогон тех же входных данных берется из кэша ответов
+    reply = await ask_gpt(system_prompt, history=[{"role": "user", "content": user_input}], priority=PRIORITY_PREMIUM, cacheable=True)
     await message.answer(f"Ответ GPT-4o:\n\n{reply}")
     await state.clear()
 
@@ -358,6 +385,7 @@ async def save_price(message: Message, state: FSMContext):
         "INSERT INTO prices (name, value, updated_at) VALUES ($1, $2, NOW()) ON CONFLICT (name) DO UPDATE SET value=$2, updated_at=NOW()",
         price_db_key, price
     )
+    await publish_invalidation(PRICES)
     
     currency = "XTR" if "stars" in price_db_key else "руб."
     await message.answer(f"Стоимость подписки обновлена: {price} {currency}")
@@ -392,5 +420,6 @@ async def save_welcome_message(message: Message, state: FSMContext):
         "INSERT INTO text_settings (key, value, updated_at) VALUES ('welcome_message', $1, NOW()) ON CONFLICT (key) DO UPDATE SET value=$1, updated_at=NOW()",
         text
     )
+    await publish_invalidation(TEXT_SETTINGS)
     await message.answer("Приветственное сообщение обновлено.")
     await state.clear()
\ No newline at end of file
@@ -0,0 +1,184 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from loguru import logger
+from .redis_client import redis_client
+
+# Продлить ключ, только если он все еще наш
+RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Удалить ключ, только если он все еще наш
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_renew_script = redis_client.register_script(RENEW_LUA)
+_release_script = redis_client.register_script(RELEASE_LUA)
+
+
+def _make_token() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def acquire(key: str, token: str, ttl: float) -> bool:
+    return bool(await redis_client.set(key, token, nx=True, px=int(ttl * 1000)))
+
+
+async def renew(key: str, token: str, ttl: float) -> bool:
+    return bool(await _renew_script(keys=[key], args=[token, int(ttl * 1000)]))
+
+
+async def release(key: str, token: str) -> bool:
+    return bool(await _release_script(keys=[key], args=[token]))
+
+
+class LeaderElection:
+    """
+    Выбор лидера среди процессов бота через аренду ключа в Redis.
+    Лидер продлевает аренду каждые ttl/3 секунд; если продлить не удалось
+    (Redis недоступен дольше срока аренды или ключ перехвачен), вызывается
+    on_revoked и процесс снова становится кандидатом. Если лидер упал, аренда
+    истекает через ttl секунд и лидером становится другой процесс.
+    """
+
+    def __init__(self, name: str, ttl: float, on_elected, on_revoked):
+        self.key = f"leader:{name}"
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.token = _make_token()
+        self.is_leader = False
+        self._renewed_at = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает выборы и отдает лидерство, чтобы другой процесс подхватил его сразу."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._revoke()
+            try:
+                await release(self.key, self.token)
+            except Exception as e:
+                logger.warning(f"Не удалось освободить {self.key}: {e}")
+
+    async def _run(self):
+        interval = self.ttl / 3
+        while True:
+            try:
+                if self.is_leader:
+                    if await renew(self.key, self.token, self.ttl):
+                        self._renewed_at = time.monotonic()
+                    else:
+                        logger.error(f"Процесс {self.token} потерял лидерство ({self.key})")
+                        await self._revoke()
+                elif await acquire(self.key, self.token, self.ttl):
+                    logger.info(f"Процесс {self.token} стал лидером ({self.key})")
+                    self._renewed_at = time.monotonic()
+                    await self._elect()
+            except Exception as e:
+                logger.error(f"Ошибка выбора лидера ({self.key}): {e}")
+                # Аренду не продлить: к этому моменту лидером мог стать другой процесс
+                if self.is_leader and time.monotonic() - self._renewed_at >= self.ttl:
+                    logger.error(f"Процесс {self.token} слагает лидерство ({self.key}): аренда истекла")
+                    await self._revoke()
+            await asyncio.sleep(interval)
+
+    async def _elect(self):
+        try:
+            await self.on_elected()
+        except Exception as e:
+            # Лидер без фоновых задач хуже, чем никакого: отдаем аренду другому процессу
+            logger.error(f"Не удалось запустить задачи лидера ({self.key}), лидерство сложено: {e}")
+            await self._revoke()
+            try:
+                await release(self.key, self.token)
+            except Exception as e:
+                logger.warning(f"Не удалось освободить {self.key}: {e}")
+            return
+        self.is_leader = True
+
+    async def _revoke(self):
+        self.is_leader = False
+        try:
+            await self.on_revoked()
+        except Exception as e:
+            logger.error(f"Ошибка при остановке задач лидера ({self.key}): {e}")
+
+
+class JobLock:
+    """
+    Результат job_lock. Истинен, если блокировка взята. lost становится True, если
+    блокировку не удалось продлить (Redis недоступен дольше ttl или ключ перехвачен):
+    задачу мог подхватить другой процесс, и долгие задачи должны проверять этот флаг
+    между шагами и останавливаться.
+    """
+
+    def __init__(self, acquired: bool):
+        self.acquired = acquired
+        self.lost = False
+
+    def __bool__(self) -> bool:
+        return self.acquired
+
+
+@asynccontextmanager
+async def job_lock(name: str, ttl: float = 30):
+    """
+    Блокировка отдельной задачи: `async with job_lock("x") as lock`.
+    Ложный lock — задачу уже выполняет другой процесс. Пока блок выполняется,
+    блокировка продлевается в фоне; если продлить не удалось, выставляется lock.lost.
+    """
+    key = f"lock:{name}"
+    token = _make_token()
+    if not await acquire(key, token, ttl):
+        yield JobLock(False)
+        return
+    lock = JobLock(True)
+
+    async def keep_alive():
+        renewed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await renew(key, token, ttl):
+                    lock.lost = True
+                    logger.error(f"Блокировка {key} потеряна во время выполнения задачи")
+                    return
+                renewed_at = time.monotonic()
+            except Exception as e:
+                logger.warning(f"Ошибка продления блокировки {key}: {e}")
+                if time.monotonic() - renewed_at >= ttl:
+                    lock.lost = True
+                    logger.error(f"Блокировка {key} истекла: не удалось продлить за {ttl} с")
+                    return
+
+    renewer = asyncio.create_task(keep_alive())
+    try:
+        yield lock
+    finally:
+        renewer.cancel()
+        try:
+            await release(key, token)
+        except Exception as e:
+            logger.warning(f"Не удалось освободить {key}: {e}")
@@ -1,27 +1,113 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
 import asyncpg
+from loguru import logger
 from ..config import settings
+from .. import metrics, tracing
+
+# Выгрузки (COPY) идут дольше обычных запросов — для них свой таймаут (сек.)
+COPY_TIMEOUT = 3600
+
+
+class PoolExhaustedError(Exception):
+    """Свободное соединение не освободилось за DB_ACQUIRE_TIMEOUT: база перегружена."""
+
 
 class Database:
     def __init__(self):
         self.pool = None
+        self._waiting = 0
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(dsn=settings.POSTGRES_DSN)
+        self.pool = await asyncpg.create_pool(
+            dsn=settings.POSTGRES_DSN,
+            min_size=settings.DB_POOL_MIN_SIZE,
+            max_size=settings.DB_POOL_MAX_SIZE,
+            command_timeout=settings.DB_COMMAND_TIMEOUT or None,
+            # PgBouncer в режиме transaction не держит подготовленные запросы между транзакциями
+            statement_cache_size=0 if settings.DB_PGBOUNCER else settings.DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=settings.DB_MAX_INACTIVE_LIFETIME,
+            server_settings={"application_name": settings.DB_APPLICATION_NAME},
+            init=self._init_connection,
+        )
+        # Значения читаются в момент сбора метрик, на запросы это не влияет
+        metrics.DB_POOL_SIZE.set_function(self.pool.get_size)
+        metrics.DB_POOL_IN_USE.set_function(lambda: self.pool.get_size() - self.pool.get_idle_size())
+        metrics.DB_POOL_MAX.set(settings.DB_POOL_MAX_SIZE)
+        metrics.DB_POOL_WAITING.set_function(lambda: self._waiting)
+        logger.info(
+            f"Пул PostgreSQL: {settings.DB_POOL_MIN_SIZE}-{settings.DB_POOL_MAX_SIZE} соединений"
+            + (", режим PgBouncer" if settings.DB_PGBOUNCER else "")
+        )
+
+    async def _init_connection(self, conn: asyncpg.Connection):
+        # Вызывается для каждого нового соединения пула (в том числе после переподключения)
+        metrics.DB_CONNECTIONS_OPENED.inc()
 
     async def close(self):
         if self.pool:
             await self.pool.close()
 
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Соединение из пула на несколько запросов подряд. Если свободного соединения
+        нет дольше DB_ACQUIRE_TIMEOUT, бросает PoolExhaustedError вместо бесконечного ожидания.
+        """
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            conn = await self.pool.acquire(timeout=settings.DB_ACQUIRE_TIMEOUT or None)
+        except asyncio.TimeoutError:
+            metrics.DB_POOL_EXHAUSTED.inc()
+            logger.warning(
+                f"Пул PostgreSQL исчерпан: нет свободного соединения за {settings.DB_ACQUIRE_TIMEOUT} с "
+                f"(занято {self.pool.get_size() - self.pool.get_idle_size()}/{settings.DB_POOL_MAX_SIZE}, ждут {self._waiting})"
+            )
+            raise PoolExhaustedError("Нет свободного соединения с базой данных") from None
+        finally:
+            self._waiting -= 1
+        waited = time.perf_counter() - started
+        metrics.DB_POOL_WAIT.observe(waited)
+        span = tracing.current_span()
+        if span is not None:
+            span.set("db.pool_wait_ms", round(waited * 1000, 3))
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Одно соединение и одна транзакция на несколько запросов: async with db.transaction() as conn."""
+        with tracing.span("db.transaction"):
+            async with self.connection() as conn:
+                async with conn.transaction():
+                    yield conn
+
+    @asynccontextmanager
+    async def _statement(self, operation: str, query: str):
+        # Спан db.* охватывает ожидание соединения и сам запрос
+        with tracing.span(f"db.{operation}", **{"db.statement": query[:500]}):
+            async with self.connection() as conn:
+                yield conn
+
     async def execute(self, query, *args, **kwargs):
-        async with self.pool.acquire() as conn:
+        async with self._statement("execute", query) as conn:
             return await conn.execute(query, *args, **kwargs)
 
     async def fetch(self, query, *args, **kwargs):
-        async with self.pool.acquire() as conn:
+        async with self._statement("fetch", query) as conn:
             return await conn.fetch(query, *args, **kwargs)
 
     async def fetchrow(self, query, *args, **kwargs):
-        async with self.pool.acquire() as conn:
+        async with self._statement("fetchrow", query) as conn:
             return await conn.fetchrow(query, *args, **kwargs)
 
+    async def copy_from_query(self, query, *args, **kwargs):
+        kwargs.setdefault("timeout", COPY_TIMEOUT)
+        async with self._statement("copy_from_query", query) as conn:
+            return await conn.copy_from_query(query, *args, **kwargs)
+
 db = Database()
@@ -1,4 +1,42 @@
+import time
 import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
 from ..config import settings
+from .. import metrics, tracing
 
-redis_client = redis.from_url(settings.REDIS_DSN, decode_responses=True)
+# Блокирующие команды ждут данных, а не Redis — их время в метрики не попадает
+BLOCKING_COMMANDS = {"BLPOP", "BRPOP", "BLMOVE", "BZPOPMIN", "BZPOPMAX", "XREAD", "XREADGROUP"}
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        with tracing.span("redis.PIPELINE", **{"redis.commands": len(self.command_stack)}):
+            try:
+                return await super().execute(raise_on_error)
+            finally:
+                metrics.REDIS_LATENCY.labels("PIPELINE").observe(time.perf_counter() - started)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Клиент Redis, который пишет длительность каждой команды в redis_command_seconds и в спан redis.*."""
+
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        if command in BLOCKING_COMMANDS:
+            return await super().execute_command(*args, **options)
+        started = time.perf_counter()
+        with tracing.span(f"redis.{command}"):
+            try:
+                return await super().execute_command(*args, **options)
+            finally:
+                metrics.REDIS_LATENCY.labels(command).observe(time.perf_counter() - started)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> Pipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# Без метрик и трассировки — обычный клиент, без лишней обертки на каждой команде
+redis_client = (
+    InstrumentedRedis if metrics.ENABLED or tracing.ENABLED else redis.Redis
+).from_url(settings.REDIS_DSN, decode_responses=True)
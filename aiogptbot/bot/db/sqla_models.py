@@ -11,7 +11,10 @@ from sqlalchemy import (
     ForeignKey,
     Text,
     TIMESTAMP,
-    Numeric
+    Numeric,
+    Date,
+    Index,
+    text as sql_text
 )
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.sql import func
@@ -35,6 +38,15 @@ class User(Base):
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     last_activity = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index('ix_users_username', 'username'),
+        Index('ix_users_status', 'status'),
+        Index('ix_users_last_activity', 'last_activity'),
+        Index('ix_users_created_at', 'created_at'),
+        Index('ix_users_banned', 'id', postgresql_where=sql_text('is_banned = TRUE')),
+        Index('ix_users_daily_count_nonzero', 'telegram_id', postgresql_where=sql_text('daily_message_count <> 0')),
+    )
+
 class Message(Base):
     __tablename__ = 'messages'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -43,6 +55,11 @@ class Message(Base):
     content = Column(Text, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index('ix_messages_user_id_created_at', 'user_id', 'created_at'),
+        Index('ix_messages_created_at', 'created_at'),
+    )
+
 class Prompt(Base):
     __tablename__ = 'prompts'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -50,6 +67,10 @@ class Prompt(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index('ix_prompts_active', 'id', postgresql_where=sql_text('is_active = TRUE')),
+    )
+
 class TextSettings(Base):
     __tablename__ = 'text_settings'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -69,6 +90,13 @@ class Payment(Base):
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
 
+    __table_args__ = (
+        Index('ix_payments_method_status', 'payment_method', 'status'),
+        Index('ix_payments_created_at', 'created_at'),
+        Index('ix_payments_pending_cryptocloud', 'created_at',
+              postgresql_where=sql_text("payment_method = 'cryptocloud' AND status = 'pending'")),
+    )
+
 class UserMemory(Base):
     __tablename__ = 'user_memory'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -100,4 +128,29 @@ class Mailing(Base):
     button_url = Column(String(255))
     segment = Column(String(50))
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
-    sent = Column(Boolean, default=False, index=True) 
\ No newline at end of file
+    sent = Column(Boolean, default=False, index=True)
+    # Прогресс рассылки: users.id последнего обработанного получателя и счетчики
+    last_user_id = Column(Integer, nullable=False, server_default='0')
+    sent_count = Column(Integer, nullable=False, server_default='0')
+    failed_count = Column(Integer, nullable=False, server_default='0')
+
+    __table_args__ = (
+        Index('ix_mailings_unsent', 'created_at', postgresql_where=sql_text('sent = FALSE')),
+    )
+
+# Суточные агрегаты для /stats; заполняются services/stats_service.refresh_daily_stats
+class DailyStats(Base):
+    __tablename__ = 'daily_stats'
+    day = Column(Date, primary_key=True)
+    dau = Column(Integer, nullable=False, server_default='0')
+    messages = Column(Integer, nullable=False, server_default='0')
+    new_users = Column(Integer, nullable=False, server_default='0')
+    payments = Column(Integer, nullable=False, server_default='0')
+    revenue_xtr = Column(Numeric(12, 2), nullable=False, server_default='0')
+    revenue_rub = Column(Numeric(12, 2), nullable=False, server_default='0')
+    # Снимок на момент последнего обновления (заполняется для текущих суток)
+    total_users = Column(Integer)
+    premium_users = Column(Integer)
+    active_7d = Column(Integer)
+    dialog_users = Column(Integer)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
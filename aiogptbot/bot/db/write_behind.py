@@ -0,0 +1,127 @@
+import asyncio
+from datetime import datetime
+import asyncpg
+from loguru import logger
+from ..config import settings
+from .postgres import db
+
+MESSAGE_COLUMNS = ["user_id", "role", "content", "created_at"]
+
+# Ошибки из-за содержимого отдельных строк (NUL-байт, битая кодировка, удаленный
+# пользователь): повтор не поможет, поэтому такие строки отбрасываются по одной
+ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, UnicodeError)
+
+# Одним запросом обновляем last_activity всем пользователям из пачки
+UPDATE_ACTIVITY_QUERY = """
+    UPDATE users u SET last_activity = v.ts
+    FROM unnest($1::bigint[], $2::timestamptz[]) AS v(telegram_id, ts)
+    WHERE u.telegram_id = v.telegram_id
+"""
+
+
+class WriteBehindQueue:
+    """
+    Отложенная пакетная запись в PostgreSQL для горячего пути диалога.
+    Сообщения (таблица messages) и last_activity копятся в памяти и сбрасываются
+    пачкой, когда набралось batch_size строк или прошло flush_interval секунд.
+    Если COPY отвергает строки пачки, пачка делится пополам до отдельных строк:
+    плохие строки логируются и отбрасываются, остальные записываются. При прочих
+    ошибках (нет соединения и т.п.) пачка возвращается в очередь (не более max_pending строк).
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0, max_pending: int = 50000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._messages: list[tuple] = []
+        self._activity: dict[int, datetime] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def add_message(self, user_db_id: int, role: str, content: str, created_at: datetime | None = None):
+        self._messages.append((user_db_id, role, content, created_at or datetime.now()))
+        if len(self._messages) >= self.batch_size:
+            self._wakeup.set()
+
+    def touch_activity(self, telegram_id: int, at: datetime | None = None):
+        self._activity[telegram_id] = at or datetime.now()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновую задачу и записывает все, что осталось в очереди."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._messages or self._activity:
+            logger.error(
+                f"Write-behind: при остановке не записано {len(self._messages)} сообщений "
+                f"и {len(self._activity)} обновлений last_activity"
+            )
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._messages and not self._activity:
+                return
+            messages, self._messages = self._messages, []
+            activity, self._activity = self._activity, {}
+            written = 0
+            try:
+                async with db.connection() as conn:
+                    if messages:
+                        rejected = await self._copy_messages(conn, messages)
+                        if rejected:
+                            logger.error(f"Write-behind: отброшено {rejected} из {len(messages)} сообщений пачки")
+                        written, messages = len(messages) - rejected, []  # уже в базе — при ошибке ниже не повторяем
+                    if activity:
+                        await conn.execute(UPDATE_ACTIVITY_QUERY, list(activity.keys()), list(activity.values()))
+                logger.debug(f"Write-behind: записано {written} сообщений, {len(activity)} last_activity")
+            except Exception as e:
+                logger.error(f"Write-behind: ошибка записи пачки ({len(messages)} сообщений): {e}")
+                self._requeue(messages, activity)
+
+    async def _copy_messages(self, conn, messages: list[tuple]) -> int:
+        """COPY пачки сообщений; возвращает, сколько строк отброшено как некорректные."""
+        try:
+            await conn.copy_records_to_table("messages", records=messages, columns=MESSAGE_COLUMNS)
+            return 0
+        except ROW_ERRORS as e:
+            if len(messages) == 1:
+                user_db_id, role, content, _ = messages[0]
+                logger.error(f"Write-behind: сообщение ({role}, user_id={user_db_id}, {len(content or '')} симв.) не записано: {e}")
+                return 1
+        middle = len(messages) // 2
+        return await self._copy_messages(conn, messages[:middle]) + await self._copy_messages(conn, messages[middle:])
+
+    def _requeue(self, messages: list[tuple], activity: dict[int, datetime]):
+        self._messages = messages + self._messages
+        overflow = len(self._messages) - self.max_pending
+        if overflow > 0:
+            logger.error(f"Write-behind: очередь переполнена, отброшено {overflow} старейших сообщений")
+            self._messages = self._messages[overflow:]
+        for telegram_id, ts in activity.items():
+            if telegram_id not in self._activity:
+                self._activity[telegram_id] = ts
+
+
+write_behind = WriteBehindQueue(
+    batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+)
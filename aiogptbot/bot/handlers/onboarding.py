@@ -3,9 +3,10 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
-from aiogram.utils.chat_action import ChatActionSender
+from ..utils.pacing import TypingPacer
 from ..db.postgres import db
-import asyncio
+from ..services.config_cache import get_text_setting
+from ..config import settings
 from loguru import logger
 
 class OnboardingStates(StatesGroup):
@@ -43,14 +44,12 @@ async def start_onboarding(message: Message, state: FSMContext, bot: Bot):
         return
     logger.info(f"--- Function start_onboarding called for user {message.from_user.id} ---")
     
-    bot_name_row = await db.fetchrow("SELECT value FROM text_settings WHERE key='bot_name'")
-    bot_name = bot_name_row['value'] if bot_name_row else "Маша"
-    
-    async with ChatActionSender(bot=bot, chat_id=message.chat.id):
-        await asyncio.sleep(1)
+    async with TypingPacer(bot, message.chat.id, settings.REPLY_PACE_TARGET) as pacer:
+        bot_name = await get_text_setting('bot_name') or "Маша"
+        await state.set_state(OnboardingStates.start_intro)
         markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=f"Привет, {bot_name}!", callback_data="intro_1_next")]])
+        await pacer.pace()
         await message.answer(f"Привет! Меня зовут {bot_name} 😊 Я буду твоим виртуальным психологом и другом.", reply_markup=markup)
-    await state.set_state(OnboardingStates.start_intro)
 
 @router.callback_query(OnboardingStates.start_intro, F.data == "intro_1_next")
 async def handle_intro_1(call: CallbackQuery, state: FSMContext, bot: Bot):
@@ -59,23 +58,23 @@ async def handle_intro_1(call: CallbackQuery, state: FSMContext, bot: Bot):
     # Удаляем предыдущее сообщение с кнопкой
     # await bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
 
-    async with ChatActionSender(bot=bot, chat_id=call.message.chat.id):
-        await asyncio.sleep(1)
+    async with TypingPacer(bot, call.message.chat.id, settings.REPLY_PACE_TARGET) as pacer:
+        await call.answer()
+        await state.set_state(OnboardingStates.second_intro)
         markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Здорово!", callback_data="intro_2_next")]])
+        await pacer.pace()
         await bot.send_message(call.message.chat.id, "💫 Я была обучена специально для того, чтобы оказывать помощь, как настоящий психолог. Наш диалог максимально приближен к процессу терапии. Я постараюсь услышать тебя, понять и помочь тебе справиться с жизненным затруднением.", reply_markup=markup)
-    await state.set_state(OnboardingStates.second_intro)
-    await call.answer()
 
 @router.callback_query(OnboardingStates.second_intro, F.data == "intro_2_next")
 async def handle_intro_2(call: CallbackQuery, state: FSMContext, bot: Bot):
     if not call.message:
         return
     # await bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    async with ChatActionSender(bot=bot, chat_id=call.message.chat.id):
-        await asyncio.sleep(1)
+    async with TypingPacer(bot, call.message.chat.id, settings.REPLY_PACE_TARGET) as pacer:
+        await call.answer()
+        await state.set_state(OnboardingStates.waiting_for_name)
+        await pacer.pace()
         await bot.send_message(call.message.chat.id, "Как я могу обращаться к тебе? Напиши только имя, например \"Маша\".")
-    await state.set_state(OnboardingStates.waiting_for_name)
-    await call.answer()
 
 @router.message(OnboardingStates.waiting_for_name, F.text)
 async def handle_name(message: Message, state: FSMContext, bot: Bot):
@@ -87,16 +86,15 @@ async def handle_name(message: Message, state: FSMContext, bot: Bot):
         await message.answer("Имя слишком длинное. Попробуй еще раз.")
         return
     
-    await state.update_data(name=name)
-    
-    async with ChatActionSender(bot=bot, chat_id=message.chat.id):
+    async with TypingPacer(bot, message.chat.id, settings.REPLY_PACE_TARGET) as pacer:
+        await state.update_data(name=name)
+        await state.set_state(OnboardingStates.waiting_for_age)
         # await bot.send_sticker(message.chat.id, "CAACAgIAAxkBAAEMAbZmZt921Lp2Gj1j2eWq-mYtW_zdDQACVgwAAg3S2UqD29_A-EEi9zQE")
-        await asyncio.sleep(1)
+        await pacer.pace()
         await message.answer(f"Я очень рада с тобой познакомиться, {name}!")
-        await asyncio.sleep(1.5)
+        # Второе сообщение подряд — пауза чуть длиннее, как будто его набирают
+        await pacer.pace(settings.REPLY_PACE_TARGET * 1.5)
         await message.answer("Скажи, пожалуйста, сколько тебе лет? Укажи цифру.\n\nЭто необходимо мне для настройки контента")
-        
-    await state.set_state(OnboardingStates.waiting_for_age)
     
 @router.message(OnboardingStates.waiting_for_age, F.text)
 async def handle_age(message: Message, state: FSMContext, bot: Bot):
@@ -109,17 +107,16 @@ async def handle_age(message: Message, state: FSMContext, bot: Bot):
         await message.answer("Укажи, пожалуйста, реальный возраст (от 10 до 100 лет).")
         return
         
-    await state.update_data(age=age)
-    
-    async with ChatActionSender(bot=bot, chat_id=message.chat.id):
-        await asyncio.sleep(1)
+    async with TypingPacer(bot, message.chat.id, settings.REPLY_PACE_TARGET) as pacer:
+        await state.update_data(age=age)
+        await state.set_state(OnboardingStates.waiting_for_gender)
         markup = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Женский", callback_data="gender_female")],
             [InlineKeyboardButton(text="Мужской", callback_data="gender_male")]
         ])
+        await pacer.pace()
         await message.answer("Отлично. А в каком роде я могу к тебе обращаться – в мужском или женском? 😇", reply_markup=markup)
 
-    await state.set_state(OnboardingStates.waiting_for_gender)
     logger.info(f"User {message.from_user.id}: State set to 'waiting_for_gender'.")
 
 @router.callback_query(OnboardingStates.waiting_for_gender, F.data.startswith("gender_"))
@@ -157,24 +154,25 @@ async def handle_gender(call: CallbackQuery, state: FSMContext, bot: Bot):
         await state.clear()
         return
 
-    try:
-        logger.info(f"User {user_id}: Preparing to update DB record.")
-        update_query = "UPDATE users SET preferred_name=$1, age=$2, gender=$3, onboarding_completed=TRUE WHERE telegram_id=$4"
-        logger.debug(f"User {user_id}: Executing SQL: {update_query} with params: [{name}, {age}, {gender}, {user_id}]")
-        
-        await db.execute(update_query, name, age, gender, user_id)
-        
-        logger.info(f"User {user_id}: DB record updated successfully. Preparing final message.")
-    except Exception as e:
-        logger.error(f"User {user_id}: DB update FAILED: {e}")
-        await call.answer("Произошла ошибка при сохранении данных. Попробуйте позже.", show_alert=True)
-        await state.clear()
-        return
+    # «Печатает» сразу, пока сохраняются данные; пауза до ответа — только остаток до REPLY_PACE_TARGET
+    async with TypingPacer(bot, call.message.chat.id, settings.REPLY_PACE_TARGET) as pacer:
+        try:
+            logger.info(f"User {user_id}: Preparing to update DB record.")
+            update_query = "UPDATE users SET preferred_name=$1, age=$2, gender=$3, onboarding_completed=TRUE WHERE telegram_id=$4"
+            logger.debug(f"User {user_id}: Executing SQL: {update_query} with params: [{name}, {age}, {gender}, {user_id}]")
 
-    # await bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    try:
-        async with ChatActionSender(bot=bot, chat_id=call.message.chat.id):
-            await asyncio.sleep(1)
+            await db.execute(update_query, name, age, gender, user_id)
+
+            logger.info(f"User {user_id}: DB record updated successfully. Preparing final message.")
+        except Exception as e:
+            logger.error(f"User {user_id}: DB update FAILED: {e}")
+            await call.answer("Произошла ошибка при сохранении данных. Попробуйте позже.", show_alert=True)
+            await state.clear()
+            return
+
+        # await bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+        try:
+            await pacer.pace()
             logger.info(f"User {user_id}: Sending final confirmation message.")
             await bot.send_message(
                 chat_id=call.message.chat.id,
@@ -182,9 +180,9 @@ async def handle_gender(call: CallbackQuery, state: FSMContext, bot: Bot):
                      "Напиши, что тебя беспокоит, и я постараюсь помочь.",
                 reply_markup=ReplyKeyboardRemove()
             )
-        logger.info(f"User {user_id}: Final message sent. Clearing state.")
-    except Exception as e:
-        logger.error(f"User {user_id}: FAILED to send final message: {e}")
+            logger.info(f"User {user_id}: Final message sent. Clearing state.")
+        except Exception as e:
+            logger.error(f"User {user_id}: FAILED to send final message: {e}")
 
     await state.clear()
     await call.answer() 
\ No newline at end of file
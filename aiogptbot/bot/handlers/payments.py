@@ -6,6 +6,7 @@ from ..config import settings
 from loguru import logger
 from datetime import datetime, timedelta
 from aiogptbot.bot.services.payment_service import create_telegram_invoice, create_cryptocloud_invoice, record_successful_telegram_payment
+from aiogptbot.bot.services.subscription_service import reset_daily_quota
 
 router = Router()
 
@@ -127,6 +128,7 @@ async def successful_payment_handler(message: Message):
         until, user_id
     )
 
+    await reset_daily_quota(user_id)
     logger.info(f"[SuccessfulPayment] User {user_id} update status: {update_result}. Now recording payment.")
 
     await record_successful_telegram_payment(
@@ -9,20 +9,27 @@ from datetime import datetime, timedelta
 from ..filters import SadEmotionFilter, PremiumFilter
 from ..db.postgres import db
 from ..db.redis_client import redis_client
-from ..services.openai_service import ask_gpt
+from ..db.write_behind import write_behind
+from ..services.openai_service import ask_gpt, stream_gpt
+from ..services.llm_scheduler import priority_for_user
 from ..services.memory_service import get_user_memory, update_user_memory
-from ..services.subscription_service import get_user_status, get_daily_limit, get_subscription_info
+from ..services.subscription_service import get_user_status, get_daily_limit, get_subscription_info, get_daily_message_count, DAILY_LIMIT
+from ..services.user_context import UserContext, load_user_context
+from ..services.config_cache import get_text_setting
+from ..services.dialog_mailbox import push_message, process_mailbox, MailboxBatch
 from loguru import logger
-import asyncio
 from aiogptbot.bot.config import settings
 import httpx
 from aiogptbot.bot.services.payment_service import create_telegram_invoice, create_cryptocloud_invoice
+from ..utils.stream_reply import send_streamed_reply
+from ..utils.pacing import TypingPacer
 from .onboarding import start_onboarding
+from ..tracing import traced
 
 router = Router()
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, bot: Bot, state: FSMContext):
+async def cmd_start(message: Message, bot: Bot, state: FSMContext, user_ctx: UserContext | None = None):
     if not message.from_user:
         return
     
@@ -34,7 +41,9 @@ async def cmd_start(message: Message, bot: Bot, state: FSMContext):
     await state.clear() 
 
     logger.info(f"User {user_id}: Fetching user from DB...")
-    user = await db.fetchrow("SELECT * FROM users WHERE telegram_id=$1", user_id)
+    if user_ctx is None:
+        user_ctx = await load_user_context(user_id)
+    user = user_ctx.user
 
     # Case 1: New user
     if not user:
@@ -54,7 +63,7 @@ async def cmd_start(message: Message, bot: Bot, state: FSMContext):
         await db.execute(
             "UPDATE users SET status='demo', daily_message_count=0 WHERE telegram_id=$1", user_id
         )
-        user = await db.fetchrow("SELECT * FROM users WHERE telegram_id=$1", user_id)
+        user.update(status='demo', daily_message_count=0)
 
     # Case 2: Existing user who hasn't completed onboarding
     onboarding_completed_raw = user.get('onboarding_completed')
@@ -70,34 +79,35 @@ async def cmd_start(message: Message, bot: Bot, state: FSMContext):
 
     # Case 3: Existing user who has completed onboarding
     logger.info(f"User {user_id}: Onboarding already completed. Sending welcome back message.")
-    async with ChatActionSender(bot=bot, chat_id=message.chat.id):
-        await asyncio.sleep(1.0)
-        
-        welcome_message_row = await db.fetchrow("SELECT value FROM text_settings WHERE key='welcome_message'")
+    async with TypingPacer(bot, message.chat.id, settings.REPLY_PACE_TARGET) as pacer:
+        welcome_message = await get_text_setting('welcome_message')
         preferred_name = user.get('preferred_name') or user.get('full_name') or "пользователь"
 
-        if welcome_message_row and welcome_message_row['value']:
-            welcome_text = welcome_message_row['value'].replace("{name}", preferred_name)
+        if welcome_message:
+            welcome_text = welcome_message.replace("{name}", preferred_name)
         else:
              welcome_text = (
                 f"<b>С возвращением, {preferred_name}!</b>\n\n"
                 "Как твои дела? Что-то случилось? Опишите вашу проблему, и мы вместе найдем решение."
             )
-            
+
+        await pacer.pace()
         await message.answer(welcome_text, parse_mode=ParseMode.HTML)
 
 @router.message(Command("profile"))
-async def cmd_profile(message: Message):
+async def cmd_profile(message: Message, user_ctx: UserContext | None = None):
     if not message.from_user:
         return
     user_id = message.from_user.id
-    user = await db.fetchrow("SELECT * FROM users WHERE telegram_id=$1", user_id)
+    if user_ctx is None:
+        user_ctx = await load_user_context(user_id)
+    user = user_ctx.user
     if not user:
         await message.answer("Профиль не найден. Напишите /start.")
         return
     status = user['status']
     sub_until = user['subscription_until']
-    daily_count = user['daily_message_count']
+    daily_count = await get_daily_message_count(user_id)
     name = user.get('preferred_name') or user.get('full_name') or user.get('username') or "Не указано"
     
     sub_text = f"до {sub_until.strftime('%d.%m.%Y')}" if sub_until else "нет"
@@ -106,11 +116,11 @@ async def cmd_profile(message: Message):
         f"Имя: {name}\n"
         f"Статус: {status}\n"
         f"Подписка: {sub_text}\n"
-        f"Сообщений сегодня: {daily_count}/5 (для demo)"
+        f"Сообщений сегодня: {daily_count}/{DAILY_LIMIT} (для demo)"
     )
 
 @router.message(F.text)
-async def dialog_handler(message: Message, bot: Bot, state: FSMContext):
+async def dialog_handler(message: Message, bot: Bot, state: FSMContext, user_ctx: UserContext | None = None):
     if not message.from_user or not message.text:
         return
 
@@ -123,7 +133,10 @@ async def dialog_handler(message: Message, bot: Bot, state: FSMContext):
     user_id = message.from_user.id
     logger.info(f"--- dialog_handler triggered for user {user_id} in state: {current_state} ---")
     
-    user = await db.fetchrow("SELECT * FROM users WHERE telegram_id=$1", user_id)
+    # Пользователь, summary и промпт уже загружены в UserContextMiddleware
+    if user_ctx is None:
+        user_ctx = await load_user_context(user_id)
+    user = user_ctx.user
     if not user:
         await message.answer("Профиль не найден. Напишите /start.")
         return
@@ -132,54 +145,61 @@ async def dialog_handler(message: Message, bot: Bot, state: FSMContext):
         await message.answer("Пожалуйста, сначала завершите короткий опрос, чтобы мы могли познакомиться. Нажмите /start")
         return
 
-    try:
-        await db.execute(
-            "INSERT INTO messages (user_id, role, content, created_at) VALUES ($1, $2, $3, $4)",
-            user['id'], 'user', message.text, datetime.now()
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при вставке сообщения пользователя: {e}")
-        return # Если не удалось сохранить сообщение, не продолжаем
+    # Сообщения пишутся в БД пачками в фоне, ответ их не ждет
+    write_behind.add_message(user['id'], 'user', message.text)
+
+    # Сообщения одного пользователя обрабатываются по очереди; все, что он успел
+    # написать, пока генерировался ответ, уходит в GPT одним запросом
+    await push_message(user_id, message.text)
+    await process_mailbox(user_id, lambda batch: _answer_dialog(message, bot, user_ctx, batch))
+
+@traced()
+async def _answer_dialog(message: Message, bot: Bot, user_ctx: UserContext, batch: MailboxBatch):
+    user_id = user_ctx.telegram_id
+    user = user_ctx.user
+    text = "\n\n".join(batch.texts)
 
     # 1. Получаем из Redis историю (список) и из Postgres summary (строку)
-    memory_data = await get_user_memory(user_id)
+    memory_data = await get_user_memory(user_id, user_ctx)
     history = memory_data["history"] 
     summary = memory_data["summary"]
 
-    # 2. Добавляем текущее сообщение пользователя в историю
-    history.append({"role": "user", "content": message.text})
+    # 2. Добавляем сообщение (или несколько подряд) пользователя в историю
+    history.append({"role": "user", "content": text})
 
     # 3. Получаем системный промпт
-    prompt_row = await db.fetchrow("SELECT text FROM prompts WHERE is_active=TRUE ORDER BY id DESC LIMIT 1")
-    system_prompt = prompt_row['text'] if prompt_row else "Ты дружелюбный AI-собеседник."
+    system_prompt = user_ctx.system_prompt or "Ты дружелюбный AI-собеседник."
     
     # Добавляем данные о пользователе в системный промпт
     user_info = f"Информация о пользователе: Имя - {user.get('preferred_name', 'Не указано')}, Возраст - {user.get('age', 'Не указан')}, Пол - {user.get('gender', 'Не указан')}."
     system_prompt = f"{system_prompt}\n{user_info}"
 
     # 4. Отправляем запрос к GPT с историей и summary
-    text_len = len(message.text)
-    delay = 3 if text_len > 100 else 1.5
-    async with ChatActionSender(bot=bot, chat_id=message.chat.id):
-        await asyncio.sleep(delay)
-        gpt_response = await ask_gpt(system_prompt, history, summary)
-        await message.answer(gpt_response)
-
-    # 5. Сохраняем сообщение ассистента в БД
-    try:
-        await db.execute(
-            "INSERT INTO messages (user_id, role, content, created_at) VALUES ($1, $2, $3, $4)",
-            user['id'], 'assistant', gpt_response, datetime.now()
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при вставке сообщения ассистента: {e}")
+    if settings.GPT_STREAMING:
+        # Ответ показывается по мере генерации, искусственная задержка не нужна
+        async with ChatActionSender(bot=bot, chat_id=message.chat.id):
+            gpt_response = await send_streamed_reply(
+                message,
+                stream_gpt(system_prompt, history, summary, priority=priority_for_user(user)),
+                edit_interval=settings.STREAM_EDIT_INTERVAL,
+                on_delivered=batch.mark_delivered,
+            )
+        gpt_response = gpt_response.strip()
+    else:
+        # Пауза до ответа — только если GPT ответил быстрее, чем «набрал бы» человек
+        target = settings.DIALOG_PACE_TARGET * (2 if len(text) > 100 else 1)
+        async with TypingPacer(bot, message.chat.id, target) as pacer:
+            gpt_response = await ask_gpt(system_prompt, history, summary, priority=priority_for_user(user))
+            await pacer.pace()
+            await message.answer(gpt_response)
+            batch.mark_delivered()
+
+    # 5. Сохраняем сообщение ассистента в БД (в фоне)
+    write_behind.add_message(user['id'], 'assistant', gpt_response)
 
     # 6. Обновляем память (историю в Redis, summary в Postgres) и last_activity
     await update_user_memory(user_id, history, gpt_response)
-    await db.execute(
-        "UPDATE users SET last_activity = $1 WHERE telegram_id = $2",
-        datetime.now(), user_id
-    )
+    write_behind.touch_activity(user_id)
     logger.info(f"User {user_id} получил ответ от GPT")
 
 @router.callback_query(F.data == "pay_telegram")
@@ -1,24 +1,39 @@
 import asyncio
+import multiprocessing
 import sys
+from aiohttp import web
 from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.fsm.storage.redis import RedisStorage
-from aiogram.types import BotCommand
+from aiogram.filters import ExceptionTypeFilter
+from aiogram.types import BotCommand, ErrorEvent
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from loguru import logger
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from alembic.config import Config
 from alembic import command
 
 from .config import settings
-from .db.postgres import db
+from .db.postgres import db, PoolExhaustedError
 from .db.redis_client import redis_client
+from .db.write_behind import write_behind
+from .db.coordination import LeaderElection, job_lock
 from .logging_config import logger
+from .metrics import start_metrics_server
 from .handlers import user, payments, onboarding
 from .services.mailing_service import poll_pending_mailings
-from .middlewares import setup_middlewares
-from aiogptbot.bot.services.payment_service import poll_cryptocloud_payments
-from aiogptbot.bot.services.subscription_service import reset_daily_limits
+from .services.config_cache import listen_for_invalidations
+from .services.llm_scheduler import log_llm_stats
+from .services.memory_service import run_summary_worker
+from .services.cryptocloud_webhook import start_cryptocloud_webhook, stop_cryptocloud_webhook, setup_cryptocloud_routes
+from .middlewares import setup_middlewares, TracingRequestMiddleware
+from . import tracing
+from aiogptbot.bot.services.payment_service import poll_cryptocloud_payments, close_http_client
+from aiogptbot.bot.services.subscription_service import reconcile_daily_counts
+from aiogptbot.bot.services.stats_service import refresh_daily_stats
 
 # Проверка переменных окружения
 REQUIRED_ENV = [settings.BOT_TOKEN, settings.OPENAI_API_KEY, settings.POSTGRES_DSN, settings.REDIS_DSN]
@@ -36,12 +51,14 @@ async def set_commands(bot: Bot):
     ]
     await bot.set_my_commands(commands)
 
-async def on_startup(bot: Bot):
-    logger.info("Подключение к PostgreSQL...")
-    await db.connect()
-    logger.info("Подключение к PostgreSQL установлено")
-    
-    # Применение миграций Alembic
+# Периодические задачи и фоновые опросы, которые сейчас выполняет этот процесс (если он лидер)
+_scheduler: AsyncIOScheduler | None = None
+_background_tasks: list[asyncio.Task] = []
+# Задачи, которые работают в каждом процессе (инвалидация кэша, воркер резюме, статистика LLM)
+_process_tasks: list[asyncio.Task] = []
+_leader: LeaderElection | None = None
+
+def apply_migrations():
     logger.info("Применение миграций БД...")
     try:
         alembic_cfg = Config("alembic.ini")
@@ -52,6 +69,55 @@ async def on_startup(bot: Bot):
         # В зависимости от политики, можно либо остановить запуск, либо продолжить
         # sys.exit(1)
 
+def locked_job(name: str, job):
+    """Задача планировщика, которая не запустится, если ее уже выполняет другой процесс."""
+    async def run():
+        async with job_lock(name) as acquired:
+            if acquired:
+                await job()
+    return run
+
+async def start_background_jobs(bot: Bot, dispatcher: Dispatcher):
+    """Одноразовые действия при старте и периодические задачи — только на лидере."""
+    global _scheduler
+    await set_commands(bot)
+    logger.info("Команды бота установлены")
+    if settings.BOT_MODE == "webhook":
+        await bot.set_webhook(
+            f"{settings.WEBHOOK_URL.rstrip('/')}{settings.WEBHOOK_PATH}",
+            secret_token=settings.WEBHOOK_SECRET or None,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+        logger.info("Вебхук Telegram установлен")
+
+    # Дневные счетчики живут в Redis и обнуляются сами; в Postgres они только переносятся
+    _scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+    _scheduler.add_job(locked_job("reconcile_daily_counts", reconcile_daily_counts), 'interval', seconds=settings.QUOTA_RECONCILE_INTERVAL)
+    _scheduler.add_job(locked_job("refresh_daily_stats", refresh_daily_stats), 'interval', seconds=settings.STATS_REFRESH_INTERVAL)
+    _scheduler.start()
+    logger.info("Планировщик периодических задач (лимиты, статистика) запущен.")
+
+    _background_tasks.append(asyncio.create_task(poll_pending_mailings(bot)))
+    _background_tasks.append(asyncio.create_task(poll_cryptocloud_payments(bot)))
+    logger.info("Фоновые задачи (рассылки, опрос CryptoCloud) запущены")
+
+async def stop_background_jobs():
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler.shutdown(wait=False)
+        _scheduler = None
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    logger.info("Фоновые задачи остановлены")
+
+async def on_startup(bot: Bot, dispatcher: Dispatcher):
+    logger.info("Подключение к PostgreSQL...")
+    await db.connect()
+    write_behind.start()
+    logger.info("Подключение к PostgreSQL установлено")
+
     logger.info("Подключение к Redis...")
     try:
         await redis_client.ping()
@@ -59,22 +125,39 @@ async def on_startup(bot: Bot):
     except Exception as e:
         logger.error(f"Ошибка подключения к Redis: {e}")
         sys.exit(1)
-        
-    await set_commands(bot)
-    logger.info("Команды бота установлены")
 
-    scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
-    scheduler.add_job(reset_daily_limits, 'cron', hour=0, minute=0)
-    scheduler.start()
-    logger.info("Планировщик для сброса лимитов запущен.")
-
-    logger.info("Запуск фоновых задач...")
-    asyncio.create_task(poll_pending_mailings(bot))
-    asyncio.create_task(poll_cryptocloud_payments(bot))
-    logger.info("Фоновые задачи запущены")
+    # Инвалидация кэша настроек нужна в каждом процессе
+    _process_tasks.append(asyncio.create_task(listen_for_invalidations()))
+    _process_tasks.append(asyncio.create_task(log_llm_stats()))
+    _process_tasks.append(asyncio.create_task(run_summary_worker()))
+    tracing.start_tracing()
+    # Фоновые задачи запускает только лидер; при его падении они переезжают в другой процесс
+    global _leader
+    _leader = LeaderElection(
+        "background_jobs",
+        ttl=settings.LEADER_LEASE_TTL,
+        on_elected=lambda: start_background_jobs(bot, dispatcher),
+        on_revoked=stop_background_jobs,
+    )
+    _leader.start()
+    # В режиме вебхука постбэки CryptoCloud принимает общее aiohttp-приложение
+    if settings.CRYPTOCLOUD_WEBHOOK_ENABLED and settings.BOT_MODE != "webhook":
+        await start_cryptocloud_webhook(bot)
     logger.info("Бот запущен")
 
 async def on_shutdown(bot: Bot):
+    if _leader is not None:
+        await _leader.stop()
+    # Фоновые задачи процесса пользуются Redis и пулом — останавливаем их до закрытия соединений
+    for task in _process_tasks:
+        task.cancel()
+    await asyncio.gather(*_process_tasks, return_exceptions=True)
+    _process_tasks.clear()
+    # Дописываем отложенные сообщения до закрытия пула
+    await stop_cryptocloud_webhook()
+    await write_behind.close()
+    await close_http_client()
+    await tracing.stop_tracing()
     await db.close()
     await redis_client.aclose()
     logger.info("Бот остановлен и соединения закрыты")
@@ -86,12 +169,39 @@ def register_handlers(dp: Dispatcher):
     dp.include_router(payments.router)
     dp.include_router(onboarding.router)
     dp.include_router(user.router)
+    dp.errors.register(on_database_busy, ExceptionTypeFilter(PoolExhaustedError))
 
-async def main():
+async def on_database_busy(event: ErrorEvent):
+    """Все соединения с БД заняты: вместо молчания просим пользователя повторить позже."""
+    text = "Сейчас сервис перегружен, попробуйте, пожалуйста, через минуту 🙏"
+    update = event.update
+    try:
+        if update.message:
+            await update.message.answer(text)
+        elif update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+        elif update.pre_checkout_query:
+            await update.pre_checkout_query.answer(ok=False, error_message=text)
+    except Exception as e:
+        logger.warning(f"Не удалось сообщить пользователю о перегрузке: {e}")
+    return True
+
+def create_bot() -> Bot:
+    session = None
+    if settings.TELEGRAM_API_URL:
+        # Свой сервер Bot API (локальный telegram-bot-api или заглушка из benchmarks/)
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_URL))
     bot = Bot(
         token=settings.BOT_TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
+    if tracing.ENABLED:
+        bot.session.middleware(TracingRequestMiddleware())
+    return bot
+
+def create_dispatcher() -> Dispatcher:
+    # FSM-состояния в Redis общие для всех процессов
     storage = RedisStorage(redis_client)
     dp = Dispatcher(storage=storage)
 
@@ -100,7 +210,12 @@ async def main():
 
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    return dp
 
+async def run_polling():
+    start_metrics_server()
+    bot = create_bot()
+    dp = create_dispatcher()
     try:
         await dp.start_polling(bot)
     except (KeyboardInterrupt, SystemExit):
@@ -108,8 +223,59 @@ async def main():
     finally:
         await bot.session.close()
 
+def run_webhook_worker(index: int = 0):
+    """Один процесс-обработчик вебхука. Несколько таких делят порт через SO_REUSEPORT."""
+    # Метрики у каждого процесса свои, поэтому и порт у каждого свой
+    start_metrics_server(settings.METRICS_PORT + index)
+    bot = create_bot()
+    dp = create_dispatcher()
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.WEBHOOK_SECRET or None,
+    ).register(app, path=settings.WEBHOOK_PATH)
+    if settings.CRYPTOCLOUD_WEBHOOK_ENABLED:
+        setup_cryptocloud_routes(app, bot)
+    setup_application(app, dp, bot=bot)
+    web.run_app(
+        app,
+        host=settings.WEBHOOK_HOST,
+        port=settings.WEBHOOK_PORT,
+        reuse_port=settings.WEBHOOK_WORKERS > 1,
+        print=None,
+    )
+
+def run_webhook():
+    if settings.WEBHOOK_WORKERS <= 1:
+        run_webhook_worker()
+        return
+    logger.info(f"Запуск {settings.WEBHOOK_WORKERS} процессов-обработчиков вебхука")
+    ctx = multiprocessing.get_context("spawn")
+    workers = [
+        ctx.Process(target=run_webhook_worker, args=(i,), name=f"bot-worker-{i}")
+        for i in range(settings.WEBHOOK_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        logger.info("Остановка бота...")
+        for worker in workers:
+            worker.join()
+
+def main():
+    # Миграции — один раз до запуска обработчиков, а не в каждом процессе
+    apply_migrations()
+    if settings.BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(run_polling())
+
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        main()
     except Exception as e:
         logger.exception(f"Ошибка при запуске: {e}")
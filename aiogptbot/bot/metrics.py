@@ -0,0 +1,85 @@
+"""
+Метрики Prometheus. Включаются, если задан METRICS_PORT и установлен prometheus_client;
+иначе все метрики — заглушки, и инструментирование почти ничего не стоит.
+"""
+from loguru import logger
+from .config import settings
+
+try:
+    import prometheus_client
+except ImportError:  # без prometheus_client метрики не собираются
+    prometheus_client = None
+
+ENABLED = bool(settings.METRICS_PORT) and prometheus_client is not None
+
+# Границы гистограмм (сек.): быстрые операции (БД, Redis) и медленные (обработчики, OpenAI)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def dec(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, function):
+        pass
+
+
+_NOOP = _NoopMetric()
+
+
+def _counter(name: str, documentation: str, labels=()):
+    return prometheus_client.Counter(name, documentation, labels) if ENABLED else _NOOP
+
+def _gauge(name: str, documentation: str, labels=()):
+    return prometheus_client.Gauge(name, documentation, labels) if ENABLED else _NOOP
+
+def _histogram(name: str, documentation: str, labels=(), buckets=SLOW_BUCKETS):
+    return prometheus_client.Histogram(name, documentation, labels, buckets=buckets) if ENABLED else _NOOP
+
+
+HANDLER_LATENCY = _histogram("bot_handler_seconds", "Время обработки апдейта", ["event", "handler"])
+HANDLER_ERRORS = _counter("bot_handler_errors_total", "Исключения в обработчиках", ["event", "handler"])
+
+OPENAI_LATENCY = _histogram("openai_request_seconds", "Длительность запроса к OpenAI (без ожидания в очереди)", ["model", "mode"])
+OPENAI_TOKENS = _counter("openai_tokens_total", "Токены OpenAI", ["model", "kind"])
+OPENAI_ERRORS = _counter("openai_errors_total", "Ошибки запросов к OpenAI", ["model", "error"])
+LLM_IN_FLIGHT = _gauge("llm_scheduler_in_flight", "Запросы к OpenAI в работе")
+LLM_QUEUED = _gauge("llm_scheduler_queued", "Запросы к OpenAI в очереди планировщика", ["priority"])
+
+DB_POOL_WAIT = _histogram("db_pool_acquire_seconds", "Ожидание соединения из пула asyncpg", buckets=FAST_BUCKETS)
+DB_POOL_IN_USE = _gauge("db_pool_in_use", "Занятые соединения пула asyncpg")
+DB_POOL_SIZE = _gauge("db_pool_size", "Открытые соединения пула asyncpg")
+DB_POOL_MAX = _gauge("db_pool_max_size", "Максимальный размер пула asyncpg")
+DB_POOL_WAITING = _gauge("db_pool_waiting", "Корутины, ожидающие соединение из пула")
+DB_POOL_EXHAUSTED = _counter("db_pool_exhausted_total", "Отказы: соединение не освободилось за DB_ACQUIRE_TIMEOUT")
+DB_CONNECTIONS_OPENED = _counter("db_connections_opened_total", "Новые соединения с Postgres")
+
+REDIS_LATENCY = _histogram("redis_command_seconds", "Длительность команды Redis", ["command"], buckets=FAST_BUCKETS)
+
+MAILING_MESSAGES = _counter("mailing_messages_total", "Сообщения рассылок", ["result"])
+PENDING_PAYMENTS = _gauge("payments_pending", "Неоплаченные счета в очереди опроса", ["method"])
+
+
+def start_metrics_server(port: int | None = None):
+    """Поднимает HTTP-эндпоинт /metrics в отдельном потоке (по процессу — свой порт)."""
+    if not settings.METRICS_PORT:
+        return
+    if prometheus_client is None:
+        logger.warning("METRICS_PORT задан, но prometheus_client не установлен — метрики отключены")
+        return
+    port = port or settings.METRICS_PORT
+    prometheus_client.start_http_server(port, addr=settings.METRICS_HOST)
+    logger.info(f"Метрики Prometheus доступны на {settings.METRICS_HOST}:{port}/metrics")
@@ -1,20 +1,67 @@
 from aiogram import BaseMiddleware
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import Message, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from loguru import logger
 from .services.subscription_service import (
     check_user_subscription,
-    increment_message_count,
+    consume_daily_quota,
+    get_daily_limit,
+    DAILY_LIMIT,
 )
+from .services.user_context import load_user_context
+from .services.flood_control import LocalFloodState, consume_flood_allowance, NEW_USER_STATUS
 from .db.postgres import db
-import time
 from .config import settings
+from . import metrics, tracing
+import time
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Корневой спан трассы на каждый апдейт (outer-middleware dp.update)."""
+    async def __call__(self, handler, event: Update, data):
+        if not tracing.ENABLED:
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        attributes = {"update.id": event.update_id, "update.type": event.event_type}
+        if user is not None:
+            attributes["user.id"] = user.id
+        with tracing.root_span("telegram.update", **attributes):
+            return await handler(event, data)
+
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """Спан на каждый вызов Bot API (middleware сессии бота)."""
+    async def __call__(self, make_request, bot, method):
+        with tracing.span(f"telegram.{method.__api_method__}"):
+            return await make_request(bot, method)
 
 
 class LoggingMiddleware(BaseMiddleware):
+    """Время обработки и исключения по обработчикам (метрики bot_handler_*, спан handler.*)."""
     async def __call__(self, handler, event, data):
         # if isinstance(event, Message) and event.from_user is not None:
         #     user = event.from_user
         #     logger.info(f"User {user.id} (@{user.username}): {event.text}")
+        if not metrics.ENABLED and not tracing.ENABLED:
+            return await handler(event, data)
+        handler_object = data.get("handler")
+        labels = (type(event).__name__, handler_object.callback.__name__ if handler_object else "unknown")
+        started = time.perf_counter()
+        with tracing.span(f"handler.{labels[1]}"):
+            try:
+                return await handler(event, data)
+            except Exception:
+                metrics.HANDLER_ERRORS.labels(*labels).inc()
+                raise
+            finally:
+                metrics.HANDLER_LATENCY.labels(*labels).observe(time.perf_counter() - started)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Один раз за апдейт загружает UserContext и кладет его в data["user_ctx"]."""
+    async def __call__(self, handler, event, data):
+        if isinstance(event, Message) and event.from_user is not None and "user_ctx" not in data:
+            data["user_ctx"] = await load_user_context(event.from_user.id)
         return await handler(event, data)
 
 
@@ -43,7 +90,9 @@ class SubscriptionMiddleware(BaseMiddleware):
             logger.debug(f"User {user_id} sent a command, skipping subscription check.")
             return await handler(event, data)
 
-        user = await db.fetchrow("SELECT * FROM users WHERE telegram_id=$1", user_id)
+        user_ctx = data.get("user_ctx") or await load_user_context(user_id)
+        data["user_ctx"] = user_ctx
+        user = user_ctx.user
         if not user:
             logger.warning(
                 f"[SubCheck] User {user_id} not found in DB. Should start with /start. Ignoring message."
@@ -56,11 +105,9 @@ class SubscriptionMiddleware(BaseMiddleware):
             await db.execute(
                 "UPDATE users SET status='demo', daily_message_count=0 WHERE telegram_id=$1", user_id
             )
-            user = await db.fetchrow("SELECT * FROM users WHERE telegram_id=$1", user_id)
+            user.update(status='demo', daily_message_count=0)
 
-        logger.debug(
-            f"[SubCheck] User {user_id}: Initial status is '{user['status']}', message count is {user['daily_message_count']}."
-        )
+        logger.debug(f"[SubCheck] User {user_id}: Initial status is '{user['status']}'.")
 
         # Проверка бана
         if user["is_banned"]:
@@ -72,15 +119,21 @@ class SubscriptionMiddleware(BaseMiddleware):
 
         # Проверка и обновление статуса подписки
         user = await check_user_subscription(user)
+        user_ctx.user = user
         logger.debug(
             f"[SubCheck] User {user_id}: Status after check_user_subscription is '{user['status']}'."
         )
 
-        # Проверка лимитов
-        limit = 5
-        is_limit_reached = user["daily_message_count"] >= limit
+        # Проверка лимита и инкремент счетчика — одна атомарная операция в Redis
+        limit = get_daily_limit(user)
+        try:
+            allowed, count = await consume_daily_quota(user_id, limit)
+        except Exception as e:
+            logger.error(f"[SubCheck] Quota check failed for user {user_id}, letting message through: {e}")
+            allowed, count = True, user.get("daily_message_count") or 0
+        user["daily_message_count"] = count
 
-        if user["status"] in ["demo", "expired"] and is_limit_reached:
+        if not allowed:
             logger.info(
                 f"[SubCheck] User {user_id} (status: {user['status']}) has reached the daily limit of {limit}. Sending payment prompt."
             )
@@ -96,37 +149,60 @@ class SubscriptionMiddleware(BaseMiddleware):
                     ]
                 ]
             )
-            text = "Доступно только 5 сообщений в день. Оформите подписку для неограниченного доступа."
+            text = f"Доступно только {DAILY_LIMIT} сообщений в день. Оформите подписку для неограниченного доступа."
             if user["status"] == "expired":
-                text = "Ваша подписка на бота закончилась. Далее вам доступно 5 сообщений в день.\\n\\nЛимит сообщений на сегодня исчерпан. Для продления подписки выберите способ оплаты:"
+                text = f"Ваша подписка на бота закончилась. Далее вам доступно {DAILY_LIMIT} сообщений в день.\\n\\nЛимит сообщений на сегодня исчерпан. Для продления подписки выберите способ оплаты:"
 
             await event.answer(text, reply_markup=markup)
             return None
 
-        await increment_message_count(user_id)
-        logger.debug(f"[SubCheck] User {user_id} message allowed. Incrementing count.")
+        logger.debug(f"[SubCheck] User {user_id} message allowed. Count today: {count}.")
         return await handler(event, data)
 
 
 class AntiFloodMiddleware(BaseMiddleware):
-    def __init__(self, rate_limit=1.0):
-        self.rate_limit = rate_limit
-        self.last_time = {}
+    """
+    Ограничение частоты сообщений (GCRA в Redis, общее для всех процессов) с лимитами
+    по статусу пользователя; до конца онбординга действует более мягкий лимит новых.
+    Статус middleware узнает из user_ctx после обработки сообщения и хранит в
+    ограниченном LRU вместе с локальным состоянием лимитера, которое отсекает явный
+    флуд без обращения к Redis.
+    """
+    def __init__(self, max_users: int = 10000):
+        self.local = LocalFloodState(max_users)
 
     async def __call__(self, handler, event, data):
         if not isinstance(event, Message) or event.from_user is None:
             return await handler(event, data)
         user_id = event.from_user.id
-        now = time.time()
-        last = self.last_time.get(user_id, 0)
-        if now - last < self.rate_limit:
-            await event.answer("Пожалуйста, не флудите.")
+
+        allowed = not self.local.is_flooding(user_id)
+        if allowed:
+            try:
+                allowed = await consume_flood_allowance(user_id, self.local.status(user_id))
+            except Exception as e:
+                # Redis недоступен — остается только локальный лимит
+                logger.warning(f"[AntiFlood] Redis check failed for user {user_id}: {e}")
+        if not allowed:
+            if self.local.should_warn(user_id):
+                await event.answer("Пожалуйста, не флудите.")
             return None
-        self.last_time[user_id] = now
-        return await handler(event, data)
+
+        self.local.record_allowed(user_id)
+        try:
+            return await handler(event, data)
+        finally:
+            user_ctx = data.get("user_ctx")
+            if user_ctx is not None and user_ctx.user:
+                user = user_ctx.user
+                self.local.set_status(user_id, user.get("status") if user.get("onboarding_completed") else NEW_USER_STATUS)
 
 
 def setup_middlewares(dp):
+    dp.update.outer_middleware(TracingMiddleware())
     dp.message.middleware(LoggingMiddleware())
-    dp.message.middleware(AntiFloodMiddleware(rate_limit=1.0))
+    dp.callback_query.middleware(LoggingMiddleware())
+    dp.pre_checkout_query.middleware(LoggingMiddleware())
+    dp.message.middleware(AntiFloodMiddleware(max_users=settings.FLOOD_LRU_SIZE))
+    dp.message.middleware(UserContextMiddleware())
     dp.message.middleware(SubscriptionMiddleware())
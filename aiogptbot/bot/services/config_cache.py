@@ -0,0 +1,104 @@
+import asyncio
+import time
+from loguru import logger
+from ..config import settings
+from ..db.postgres import db
+from ..db.redis_client import redis_client
+
+# Канал, в который админ-бот публикует, какие настройки он изменил
+CONFIG_INVALIDATION_CHANNEL = "config:invalidate"
+
+# Разделы кэша; значение в канале — один из них или "*" (сбросить все)
+PROMPT = "prompt"
+PRICES = "prices"
+TEXT_SETTINGS = "text_settings"
+
+
+class ConfigCache:
+    """
+    Кэш редко меняющихся настроек (промпт, цены, тексты) в памяти процесса.
+    Значения живут до инвалидации через Redis pub/sub; TTL — страховка
+    на случай потерянного сообщения.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._values: dict[str, tuple[float, object]] = {}
+        self._generation = 0
+
+    async def get(self, key: str, loader):
+        entry = self._values.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        generation = self._generation
+        value = await loader()
+        # Если пока шла загрузка пришла инвалидация, значение могло устареть — не кэшируем
+        if generation == self._generation:
+            self._values[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, section: str = "*"):
+        self._generation += 1
+        if section == "*":
+            self._values.clear()
+            return
+        for key in [k for k in self._values if k == section or k.startswith(f"{section}:")]:
+            del self._values[key]
+
+
+config_cache = ConfigCache(ttl=settings.CONFIG_CACHE_TTL)
+
+
+async def get_active_prompt() -> str | None:
+    async def load():
+        row = await db.fetchrow("SELECT text FROM prompts WHERE is_active=TRUE ORDER BY id DESC LIMIT 1")
+        return row['text'] if row else None
+    return await config_cache.get(PROMPT, load)
+
+
+async def get_price(name: str) -> int | None:
+    async def load():
+        row = await db.fetchrow("SELECT value FROM prices WHERE name=$1", name)
+        return int(row['value']) if row else None
+    return await config_cache.get(f"{PRICES}:{name}", load)
+
+
+async def get_text_setting(key: str) -> str | None:
+    async def load():
+        row = await db.fetchrow("SELECT value FROM text_settings WHERE key=$1", key)
+        return row['value'] if row else None
+    return await config_cache.get(f"{TEXT_SETTINGS}:{key}", load)
+
+
+async def publish_invalidation(section: str = "*"):
+    """Вызывать после изменения настроек (админ-бот), чтобы основной бот перечитал их."""
+    try:
+        await redis_client.publish(CONFIG_INVALIDATION_CHANNEL, section)
+    except Exception as e:
+        logger.error(f"Не удалось опубликовать инвалидацию настроек '{section}': {e}")
+
+
+async def listen_for_invalidations():
+    """
+    Запускать как отдельную задачу. Слушает канал инвалидации и сбрасывает
+    соответствующие разделы кэша; после переподключения сбрасывает весь кэш,
+    так как сообщения за время разрыва могли быть потеряны.
+    """
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(CONFIG_INVALIDATION_CHANNEL)
+            config_cache.invalidate("*")
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                section = message.get("data") or "*"
+                logger.info(f"Получена инвалидация настроек: {section}")
+                config_cache.invalidate(section)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Подписка на инвалидацию настроек прервалась: {e}")
+            await asyncio.sleep(5)
+        finally:
+            await pubsub.aclose()
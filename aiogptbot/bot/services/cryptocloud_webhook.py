@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from aiohttp import web
+from aiogram import Bot
+from loguru import logger
+from ..config import settings
+from .payment_service import activate_cryptocloud_invoice
+
+# Ключ, под которым бот хранится в приложении aiohttp
+BOT_KEY = web.AppKey("bot", Bot)
+
+_runner: web.AppRunner | None = None
+
+
+def _b64decode(part: str) -> bytes:
+    return base64.urlsafe_b64decode(part + "=" * (-len(part) % 4))
+
+
+def verify_postback_token(token: str, secret: str) -> dict | None:
+    """
+    Проверяет JWT из постбэка CryptoCloud (HS256, подписан секретным ключом проекта).
+    Возвращает полезную нагрузку или None, если подпись неверна или токен истек.
+    """
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_b64decode(header_b64))
+        payload = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except (ValueError, TypeError):
+        return None
+    if header.get("alg") != "HS256":
+        return None
+    expected = hmac.new(secret.encode(), f"{header_b64}.{payload_b64}".encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected):
+        return None
+    if "exp" in payload and payload["exp"] < time.time():
+        return None
+    return payload
+
+
+def _strip_invoice_prefix(invoice_id) -> str:
+    # В постбэке номер счета приходит без префикса INV-, в токене и в базе может быть с ним
+    invoice_id = str(invoice_id or "")
+    return invoice_id[4:] if invoice_id.startswith("INV-") else invoice_id
+
+
+async def handle_postback(request: web.Request) -> web.Response:
+    """Постбэк CryptoCloud об оплате счета."""
+    if not settings.CRYPTOCLOUD_SECRET_KEY:
+        # С пустым ключом подпись может сделать кто угодно
+        logger.error("Постбэк CryptoCloud отклонен: CRYPTOCLOUD_SECRET_KEY не задан")
+        return web.json_response({"message": "Webhook is not configured"}, status=401)
+
+    try:
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+    except (json.JSONDecodeError, UnicodeDecodeError, ValueError):
+        return web.json_response({"message": "Malformed body"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"message": "Malformed body"}, status=400)
+
+    invoice_id = _strip_invoice_prefix(data.get("invoice_id"))
+    payload = verify_postback_token(str(data.get("token", "")), settings.CRYPTOCLOUD_SECRET_KEY)
+    if payload is None:
+        logger.warning(f"Постбэк CryptoCloud с неверной подписью: invoice_id={invoice_id}")
+        return web.json_response({"message": "Invalid token"}, status=401)
+    # Токен подписан для конкретного счета: чужой токен не должен активировать другой счет
+    if not invoice_id or _strip_invoice_prefix(payload.get("id")) != invoice_id:
+        logger.warning(f"Постбэк CryptoCloud: токен выписан для счета {payload.get('id')}, а не {invoice_id}")
+        return web.json_response({"message": "Invalid token"}, status=401)
+
+    if data.get("status") == "success":
+        if not await activate_cryptocloud_invoice(request.app[BOT_KEY], invoice_id):
+            # Уже активирован (повторный постбэк или опрос успел раньше) либо неизвестный счет
+            logger.info(f"Постбэк CryptoCloud: нет pending-платежа для счета {invoice_id}")
+    return web.json_response({"message": "Postback received"})
+
+
+def setup_cryptocloud_routes(app: web.Application, bot: Bot):
+    if not settings.CRYPTOCLOUD_SECRET_KEY:
+        logger.error("CRYPTOCLOUD_SECRET_KEY не задан: постбэки CryptoCloud будут отклоняться, оплаты подберет опрос")
+    app[BOT_KEY] = bot
+    app.router.add_post(settings.CRYPTOCLOUD_WEBHOOK_PATH, handle_postback)
+
+
+async def start_cryptocloud_webhook(bot: Bot):
+    """Поднимает HTTP-сервер для постбэков внутри процесса бота."""
+    global _runner
+    if not settings.CRYPTOCLOUD_SECRET_KEY:
+        logger.error("Вебхук CryptoCloud не запущен: не задан CRYPTOCLOUD_SECRET_KEY (без него постбэки не проверить)")
+        return
+    app = web.Application()
+    setup_cryptocloud_routes(app, bot)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    site = web.TCPSite(_runner, settings.CRYPTOCLOUD_WEBHOOK_HOST, settings.CRYPTOCLOUD_WEBHOOK_PORT)
+    await site.start()
+    logger.info(
+        f"Вебхук CryptoCloud слушает {settings.CRYPTOCLOUD_WEBHOOK_HOST}:"
+        f"{settings.CRYPTOCLOUD_WEBHOOK_PORT}{settings.CRYPTOCLOUD_WEBHOOK_PATH}"
+    )
+
+
+async def stop_cryptocloud_webhook():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,109 @@
+from dataclasses import dataclass
+from loguru import logger
+from ..db.redis_client import redis_client
+from ..db.coordination import job_lock
+from ..tracing import traced
+
+MAILBOX_KEY_PREFIX = "mailbox"
+# Неразобранные сообщения не должны жить вечно, если обработчик упал
+MAILBOX_TTL = 600
+# Сколько раз пробовать обработать одни и те же сообщения, прежде чем отбросить их
+MAILBOX_MAX_ATTEMPTS = 2
+
+# Забрать все накопившиеся сообщения одной атомарной операцией,
+# заодно узнать, сколько раз они уже не обработались
+DRAIN_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+return {tonumber(redis.call('GET', KEYS[2]) or '0'), items}
+"""
+_drain_script = redis_client.register_script(DRAIN_LUA)
+
+
+@dataclass
+class MailboxBatch:
+    """
+    Сообщения пользователя для одного ответа. Обработчик вызывает mark_delivered(),
+    как только пользователь увидел ответ (или его начало): после этого сообщения
+    при ошибке не повторяются, иначе ответ задублируется.
+    """
+    texts: list[str]
+    delivered: bool = False
+
+    def mark_delivered(self):
+        self.delivered = True
+
+
+def _mailbox_key(user_id: int) -> str:
+    return f"{MAILBOX_KEY_PREFIX}:{user_id}"
+
+
+def _attempts_key(user_id: int) -> str:
+    return f"{MAILBOX_KEY_PREFIX}:{user_id}:attempts"
+
+
+async def push_message(user_id: int, text: str):
+    key = _mailbox_key(user_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, text)
+        pipe.expire(key, MAILBOX_TTL)
+        await pipe.execute()
+
+
+async def drain_messages(user_id: int) -> tuple[list[str], int]:
+    """Забирает все сообщения ящика; возвращает (сообщения, число прошлых неудачных попыток)."""
+    attempts, items = await _drain_script(keys=[_mailbox_key(user_id), _attempts_key(user_id)])
+    return items, attempts
+
+
+async def _retry_later(user_id: int, batch: MailboxBatch, attempts: int):
+    """После ошибки возвращает сообщения в начало ящика, если их еще можно повторить."""
+    attempts += 1
+    if batch.delivered or attempts >= MAILBOX_MAX_ATTEMPTS:
+        reason = "ответ уже отправлен" if batch.delivered else f"попыток: {attempts}"
+        logger.warning(f"User {user_id}: {len(batch.texts)} сообщений не будут обработаны повторно ({reason})")
+        await redis_client.delete(_attempts_key(user_id))
+        return
+    key = _mailbox_key(user_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lpush(key, *reversed(batch.texts))
+        pipe.expire(key, MAILBOX_TTL)
+        pipe.set(_attempts_key(user_id), attempts, ex=MAILBOX_TTL)
+        await pipe.execute()
+
+
+@traced()
+async def process_mailbox(user_id: int, process_batch):
+    """
+    Обрабатывает почтовый ящик пользователя строго по очереди (блокировка в Redis,
+    общая для всех процессов). Если ящик уже обрабатывается, просто возвращается:
+    сообщение заберет текущий обработчик. Все, что пришло, пока шла генерация,
+    передается в process_batch одним MailboxBatch. Если process_batch упал до того,
+    как пользователь увидел ответ, сообщения возвращаются в ящик и будут обработаны
+    со следующим сообщением пользователя — не больше MAILBOX_MAX_ATTEMPTS раз.
+    """
+    while True:
+        async with job_lock(f"dialog:{user_id}") as lock:
+            if not lock:
+                return
+            while not lock.lost:
+                texts, attempts = await drain_messages(user_id)
+                if not texts:
+                    break
+                if len(texts) > 1:
+                    logger.info(f"User {user_id}: {len(texts)} сообщений объединены в один запрос")
+                batch = MailboxBatch(texts)
+                try:
+                    await process_batch(batch)
+                except Exception:
+                    await _retry_later(user_id, batch, attempts)
+                    raise
+                if attempts:
+                    await redis_client.delete(_attempts_key(user_id))
+            if lock.lost:
+                # Ящик мог забрать другой процесс — оставляем оставшиеся сообщения ему
+                return
+        # Сообщение могло прийти между последней выборкой и снятием блокировки,
+        # а его обработчик в это время не смог взять блокировку
+        if not await redis_client.llen(_mailbox_key(user_id)):
+            return
@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from ..config import settings
+from ..db.redis_client import redis_client
+from ..tracing import traced
+
+FLOOD_KEY_PREFIX = "flood"
+
+# GCRA (generic cell rate algorithm): в Redis хранится одно число на пользователя —
+# теоретическое время прихода следующего сообщения (TAT, мс). Сообщение разрешено,
+# если TAT не ушел вперед больше чем на burst интервалов. Время берется у Redis,
+# чтобы часы разных хостов не влияли на результат.
+# KEYS[1] — ключ пользователя, ARGV[1] — интервал между сообщениями (мс), ARGV[2] — burst.
+# Возвращает 1, если сообщение разрешено, иначе 0.
+GCRA_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < now then
+    tat = now
+end
+if tat - now > (burst - 1) * interval then
+    return 0
+end
+tat = tat + interval
+redis.call('SET', KEYS[1], tat, 'PX', tat - now)
+return 1
+"""
+_gcra_script = redis_client.register_script(GCRA_LUA)
+
+# Статус для тех, кто еще не прошел онбординг (или чей статус процесс пока не знает):
+# ответы на вопросы онбординга идут подряд, поэтому лимит не строже 1 сообщения в секунду
+NEW_USER_STATUS = 'new'
+
+# Лимиты по статусу пользователя: (сообщений в секунду в среднем, сколько можно подряд)
+FLOOD_LIMITS = {
+    NEW_USER_STATUS: (settings.FLOOD_RATE_NEW, settings.FLOOD_BURST_NEW),
+    'demo': (settings.FLOOD_RATE_DEMO, settings.FLOOD_BURST_DEMO),
+    'expired': (settings.FLOOD_RATE_DEMO, settings.FLOOD_BURST_DEMO),
+    'premium': (settings.FLOOD_RATE_PREMIUM, settings.FLOOD_BURST_PREMIUM),
+}
+
+
+def get_flood_limit(status: str | None) -> tuple[float, int]:
+    return FLOOD_LIMITS.get(status, FLOOD_LIMITS[NEW_USER_STATUS])
+
+
+@traced()
+async def consume_flood_allowance(user_id: int, status: str | None) -> bool:
+    """Засчитывает сообщение в общем для всех процессов лимите. True — сообщение разрешено."""
+    rate, burst = get_flood_limit(status)
+    allowed = await _gcra_script(
+        keys=[f"{FLOOD_KEY_PREFIX}:{user_id}"], args=[int(1000 / rate), burst]
+    )
+    return bool(allowed)
+
+
+class LocalFloodState:
+    """
+    Состояние лимитера в памяти процесса для последних max_users пользователей (LRU):
+    статус пользователя и TAT по сообщениям, которые пропустил этот процесс.
+    Локальный TAT не больше общего, поэтому если уже он запрещает сообщение,
+    общий лимит запретит тем более — такие сообщения отбрасываются без Redis.
+    """
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        # user_id -> [статус, TAT (time.monotonic), было ли уже предупреждение]
+        self._entries: OrderedDict[int, list] = OrderedDict()
+
+    def _entry(self, user_id: int) -> list:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = [None, 0.0, False]
+            if len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    def status(self, user_id: int) -> str | None:
+        return self._entry(user_id)[0]
+
+    def set_status(self, user_id: int, status: str | None):
+        self._entry(user_id)[0] = status
+
+    def is_flooding(self, user_id: int) -> bool:
+        entry = self._entry(user_id)
+        rate, burst = get_flood_limit(entry[0])
+        return entry[1] - time.monotonic() > (burst - 1) / rate
+
+    def record_allowed(self, user_id: int):
+        entry = self._entry(user_id)
+        rate, _ = get_flood_limit(entry[0])
+        entry[1] = max(entry[1], time.monotonic()) + 1 / rate
+        entry[2] = False
+
+    def should_warn(self, user_id: int) -> bool:
+        """Предупреждаем о флуде один раз за серию отброшенных сообщений."""
+        entry = self._entry(user_id)
+        warn, entry[2] = not entry[2], True
+        return warn
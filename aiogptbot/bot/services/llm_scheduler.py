@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+import openai
+from loguru import logger
+from ..config import settings
+from .. import metrics
+
+# Классы приоритета: чем меньше число, тем раньше запрос получит слот
+PRIORITY_PREMIUM = 0
+PRIORITY_DEMO = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_PREMIUM: "premium", PRIORITY_DEMO: "demo", PRIORITY_BACKGROUND: "background"}
+
+# Окно, в котором считается бюджет токенов
+BUDGET_WINDOW = 60.0
+
+
+def priority_for_user(user: dict | None) -> int:
+    return PRIORITY_PREMIUM if user and user.get('status') == 'premium' else PRIORITY_DEMO
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """Экспоненциальная пауза с полным джиттером; Retry-After от OpenAI, если он больше."""
+    delay = random.uniform(0, min(settings.LLM_RETRY_MAX_DELAY, settings.LLM_RETRY_BASE_DELAY * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+class LLMSlot:
+    """Выданный слот: через report() можно уточнить, сколько токенов запрос потратил на самом деле."""
+
+    def __init__(self, spent: list):
+        self._spent = spent
+
+    def report(self, total_tokens: int):
+        self._spent[1] = total_tokens
+
+
+class LLMScheduler:
+    """
+    Очередь запросов к OpenAI в пределах процесса: не больше max_concurrency
+    одновременных запросов и не больше tokens_per_minute токенов за скользящую
+    минуту (0 — без ограничения). Ожидающие запросы получают слот в порядке
+    приоритета, внутри класса — в порядке прихода.
+    """
+
+    def __init__(self, max_concurrency: int, tokens_per_minute: int = 0):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self._in_flight = 0
+        # (приоритет, порядковый номер, токены, future)
+        self._waiters: list[tuple[int, int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        # [время старта, токены] запросов за последнюю минуту
+        self._spent: deque[list] = deque()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _tokens_used(self, now: float) -> int:
+        while self._spent and self._spent[0][0] <= now - BUDGET_WINDOW:
+            self._spent.popleft()
+        return sum(tokens for _, tokens in self._spent)
+
+    def _can_start(self, tokens: int, now: float) -> bool:
+        if self._in_flight >= self.max_concurrency:
+            return False
+        if not self.tokens_per_minute:
+            return True
+        used = self._tokens_used(now)
+        # Запрос больше всего бюджета пропускаем в пустое окно, иначе он ждал бы вечно
+        return used + tokens <= self.tokens_per_minute or used == 0
+
+    def _start(self, tokens: int, now: float) -> LLMSlot:
+        self._in_flight += 1
+        spent = [now, tokens]
+        self._spent.append(spent)
+        return LLMSlot(spent)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._can_start(tokens, now):
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(self._start(tokens, now))
+        # Очередь стоит из-за бюджета, а не из-за занятых слотов — проснемся, когда окно сдвинется
+        if self._waiters and self._in_flight < self.max_concurrency and self._spent and self._timer is None:
+            delay = self._spent[0][0] + BUDGET_WINDOW - now
+            self._timer = asyncio.get_running_loop().call_later(max(delay, 0.01), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _release(self):
+        self._in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: int, tokens: int):
+        now = time.monotonic()
+        if not self._waiters and self._can_start(tokens, now):
+            slot = self._start(tokens, now)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+            try:
+                slot = await future
+            except asyncio.CancelledError:
+                # Слот могли выдать в момент отмены — вернуть его
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+        try:
+            yield slot
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        queued = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, future in self._waiters:
+            if not future.done():
+                queued[PRIORITY_NAMES.get(priority, str(priority))] += 1
+        return {
+            "in_flight": self._in_flight,
+            "queued": queued,
+            "tokens_last_minute": self._tokens_used(time.monotonic()),
+        }
+
+
+llm_scheduler = LLMScheduler(settings.LLM_MAX_CONCURRENCY, settings.LLM_TOKENS_PER_MINUTE)
+
+# Загрузка планировщика читается в момент сбора метрик
+metrics.LLM_IN_FLIGHT.set_function(lambda: llm_scheduler.stats()["in_flight"])
+for _name in PRIORITY_NAMES.values():
+    metrics.LLM_QUEUED.labels(_name).set_function(lambda name=_name: llm_scheduler.stats()["queued"][name])
+
+
+async def log_llm_stats(interval: float = 60):
+    """Раз в interval секунд пишет в лог загрузку планировщика, если есть очередь."""
+    while True:
+        await asyncio.sleep(interval)
+        stats = llm_scheduler.stats()
+        if any(stats["queued"].values()):
+            logger.info(
+                f"OpenAI: в работе {stats['in_flight']}, в очереди {stats['queued']}, "
+                f"токенов за минуту {stats['tokens_last_minute']}"
+            )
@@ -1,25 +1,192 @@
 from typing import Optional
 from ..db.postgres import db
+from ..db.coordination import job_lock
 from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from loguru import logger
 from datetime import datetime, timedelta
 from ..config import settings
+from .. import metrics
 import asyncio
+import time
 
 ADMIN_IDS = [int(x) for x in settings.ADMIN_IDS.split(',') if x]
 
-async def get_user_ids(segment: str):
-    if segment == 'all':
-        rows = await db.fetch("SELECT telegram_id FROM users WHERE is_banned=FALSE")
-    elif segment == 'subscribers':
-        rows = await db.fetch("SELECT telegram_id FROM users WHERE status='premium' AND is_banned=FALSE")
-    elif segment == 'active_7d':
-        rows = await db.fetch("SELECT telegram_id FROM users WHERE last_activity > $1 AND is_banned=FALSE", datetime.now() - timedelta(days=7))
-    else:
-        rows = []
-    # Исключаем админов
-    return [r['telegram_id'] for r in rows if r['telegram_id'] not in ADMIN_IDS]
+
+class TokenBucket:
+    """
+    Глобальный ограничитель скорости: не больше rate отправок в секунду
+    с допустимым всплеском capacity. pause() останавливает все отправки,
+    когда Telegram ответил RetryAfter.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+send_limiter = TokenBucket(rate=settings.MAILING_RATE, capacity=settings.MAILING_RATE)
+
+
+# Условия отбора получателей по сегментам; $4 — граница активности для active_7d
+SEGMENT_FILTERS = {
+    'all': "is_banned=FALSE",
+    'subscribers': "status='premium' AND is_banned=FALSE",
+    'active_7d': "last_activity > $4 AND is_banned=FALSE",
+}
+
+
+async def iter_recipients(segment: str, after_id: int = 0, page_size: int = 500):
+    """
+    Асинхронный генератор получателей сегмента: отдает страницы [(users.id, telegram_id)]
+    в порядке users.id. Страницы выбираются keyset-пагинацией (id > последний id),
+    админы исключаются в SQL, так что в памяти держится только одна страница.
+    """
+    condition = SEGMENT_FILTERS.get(segment)
+    if condition is None:
+        logger.warning(f"Неизвестный сегмент рассылки: {segment}")
+        return
+    query = (
+        f"SELECT id, telegram_id FROM users WHERE {condition} "
+        "AND id > $1 AND telegram_id <> ALL($2::bigint[]) ORDER BY id LIMIT $3"
+    )
+    extra_args = [datetime.now() - timedelta(days=7)] if segment == 'active_7d' else []
+    while True:
+        rows = await db.fetch(query, after_id, ADMIN_IDS, page_size, *extra_args)
+        if not rows:
+            return
+        yield [(r['id'], r['telegram_id']) for r in rows]
+        after_id = rows[-1]['id']
+        if len(rows) < page_size:
+            return
+
+
+def _build_markup(button_text: Optional[str], button_url: Optional[str]):
+    if button_text and button_url:
+        return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=button_text, url=button_url)]])
+    return None
+
+
+async def _send_one(bot: Bot, uid: int, text: str, markup, mailing_id: int, lock) -> bool:
+    # RetryAfter — ограничение скорости всего бота, а не ошибка получателя: после паузы
+    # повторяем тому же получателю, иначе курсор уйдет дальше и он не получит рассылку
+    while not lock.lost:
+        await send_limiter.acquire()
+        try:
+            await bot.send_message(uid, text, reply_markup=markup)
+            metrics.MAILING_MESSAGES.labels("sent").inc()
+            return True
+        except TelegramRetryAfter as e:
+            metrics.MAILING_MESSAGES.labels("retry_after").inc()
+            logger.warning(f"Рассылка {mailing_id}: Telegram просит подождать {e.retry_after} с")
+            send_limiter.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Пользователь заблокировал бота или удалил аккаунт — повторять бессмысленно
+            logger.debug(f"Не удалось отправить сообщение {uid} в рамках рассылки {mailing_id}: {e}")
+            metrics.MAILING_MESSAGES.labels("blocked").inc()
+            return False
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сообщение {uid} в рамках рассылки {mailing_id}: {e}")
+            metrics.MAILING_MESSAGES.labels("failed").inc()
+            return False
+    return False
+
+
+async def _send_batch(bot: Bot, user_ids: list[int], text: str, markup, mailing_id: int, lock):
+    """
+    Отправляет пачку сообщений пулом из MAILING_WORKERS параллельных отправителей.
+    После потери блокировки новые отправки не начинаются.
+    """
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for uid in user_ids:
+        queue.put_nowait(uid)
+    sent, failed = 0, 0
+
+    async def worker():
+        nonlocal sent, failed
+        while not lock.lost:
+            try:
+                uid = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if await _send_one(bot, uid, text, markup, mailing_id, lock):
+                sent += 1
+            else:
+                failed += 1
+
+    await asyncio.gather(*(worker() for _ in range(min(settings.MAILING_WORKERS, len(user_ids)))))
+    return sent, failed
+
+
+async def run_mailing(bot: Bot, mailing) -> tuple[int, int]:
+    """
+    Отправляет рассылку, продолжая с сохраненного курсора (mailings.last_user_id).
+    Получатели читаются из БД страницами по MAILING_BATCH_SIZE; после каждой страницы
+    курсор и счетчики сохраняются, так что после падения повторно получит
+    сообщение не больше одной пачки. Рассылку одновременно ведет только один
+    процесс (блокировка в Redis); если она уже идет, возвращает (0, 0). Если
+    блокировка потеряна, рассылка останавливается, не сдвигая курсор: ее
+    продолжит процесс, перехвативший блокировку.
+    """
+    async with job_lock(f"mailing:{mailing['id']}") as lock:
+        if not lock:
+            logger.info(f"Рассылка {mailing['id']} уже выполняется другим процессом")
+            return 0, 0
+        # Пока ждали, рассылку мог продвинуть или завершить другой процесс — берем свежий курсор
+        mailing = await db.fetchrow("SELECT * FROM mailings WHERE id=$1 AND sent=FALSE", mailing['id'])
+        if not mailing:
+            return 0, 0
+        return await _run_mailing(bot, mailing, lock)
+
+
+async def _run_mailing(bot: Bot, mailing, lock) -> tuple[int, int]:
+    mailing_id = mailing['id']
+    cursor = mailing['last_user_id'] or 0
+    sent, failed = mailing['sent_count'] or 0, mailing['failed_count'] or 0
+    markup = _build_markup(mailing['button_text'], mailing['button_url'])
+    started = time.monotonic()
+
+    async for batch in iter_recipients(mailing['segment'], after_id=cursor, page_size=settings.MAILING_BATCH_SIZE):
+        batch_sent, batch_failed = await _send_batch(bot, [uid for _, uid in batch], mailing['text'], markup, mailing_id, lock)
+        if lock.lost:
+            logger.error(f"Рассылка {mailing_id} остановлена: блокировка потеряна, курсор {cursor}")
+            return sent + batch_sent, failed + batch_failed
+        sent += batch_sent
+        failed += batch_failed
+        cursor = batch[-1][0]
+        await db.execute(
+            "UPDATE mailings SET last_user_id=$2, sent_count=$3, failed_count=$4 WHERE id=$1",
+            mailing_id, cursor, sent, failed
+        )
+        logger.info(f"Рассылка {mailing_id}: отправлено {sent}, ошибок {failed}, курсор {cursor}")
+
+    await db.execute("UPDATE mailings SET sent=TRUE WHERE id=$1", mailing_id)
+    logger.info(f"Рассылка {mailing_id} завершена за {time.monotonic() - started:.0f} с: отправлено {sent}, ошибок {failed}")
+    return sent, failed
+
 
 async def send_mailing(
     bot: Bot,
@@ -28,53 +195,30 @@ async def send_mailing(
     button_text: Optional[str] = None,
     button_url: Optional[str] = None
 ):
-    user_ids = await get_user_ids(segment)
-    markup = None
-    if button_text and button_url:
-        markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=button_text, url=button_url)]])
-    sent, failed = 0, 0
-    for uid in user_ids:
-        try:
-            await bot.send_message(uid, text, reply_markup=markup)
-            sent += 1
-        except Exception as e:
-            logger.warning(f"Не удалось отправить сообщение {uid}: {e}")
-            failed += 1
-    await db.execute(
-        "INSERT INTO mailings (text, button_text, button_url, segment, created_at, sent) VALUES ($1, $2, $3, $4, $5, TRUE)",
+    mailing = await db.fetchrow(
+        "INSERT INTO mailings (text, button_text, button_url, segment, created_at, sent) VALUES ($1, $2, $3, $4, $5, FALSE) RETURNING *",
         text, button_text, button_url, segment, datetime.now()
     )
-    logger.info(f"Рассылка завершена: отправлено {sent}, ошибок {failed}")
-    return sent, failed
+    return await run_mailing(bot, mailing)
+
 
 async def poll_pending_mailings(bot: Bot):
     """
     Запускать как отдельную задачу. Опрашивает БД на наличие неотправленных
-    рассылок и отправляет их согласно сегменту.
+    рассылок и отправляет их согласно сегменту. Прерванные рассылки
+    продолжаются с сохраненного курсора.
     """
     await asyncio.sleep(10) # Начальная задержка перед первым запуском
     while True:
         mailings = await db.fetch("SELECT * FROM mailings WHERE sent=FALSE ORDER BY created_at ASC")
         for mailing in mailings:
-            logger.info(f"Начинается рассылка {mailing['id']} для сегмента {mailing['segment']}")
-            
-            user_ids = await get_user_ids(mailing['segment'])
-            
-            markup = None
-            if mailing['button_text'] and mailing['button_url']:
-                markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=mailing['button_text'], url=mailing['button_url'])]])
-            
-            sent, failed = 0, 0
-            for uid in user_ids:
-                try:
-                    await bot.send_message(uid, mailing['text'], reply_markup=markup)
-                    sent += 1
-                    await asyncio.sleep(0.1) # небольшая задержка между отправками
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить сообщение {uid} в рамках рассылки {mailing['id']}: {e}")
-                    failed += 1
-            
-            await db.execute("UPDATE mailings SET sent=TRUE WHERE id=$1", mailing['id'])
-            logger.info(f"Рассылка {mailing['id']} завершена: отправлено {sent}, ошибок {failed}")
-        
-        await asyncio.sleep(60) # Пауза между проверками
+            if mailing['last_user_id']:
+                logger.info(f"Продолжается рассылка {mailing['id']} для сегмента {mailing['segment']} с курсора {mailing['last_user_id']}")
+            else:
+                logger.info(f"Начинается рассылка {mailing['id']} для сегмента {mailing['segment']}")
+            try:
+                await run_mailing(bot, mailing)
+            except Exception as e:
+                logger.error(f"Рассылка {mailing['id']} прервана: {e}")
+
+        await asyncio.sleep(settings.MAILING_POLL_INTERVAL) # Пауза между проверками
@@ -1,13 +1,35 @@
 from ..db.redis_client import redis_client
 from ..db.postgres import db
+from ..db.coordination import job_lock
+from ..config import settings
+from .user_context import UserContext
+from ..tracing import traced
+import asyncio
 import json
 from loguru import logger
 
 MEMORY_LIMIT = 10  # 5 пар (user, assistant)
 
-async def get_user_memory(user_id: int) -> dict:
+# Очередь пользователей, чье резюме пора обновить; отметка queued защищает от дублей
+SUMMARY_QUEUE_KEY = "summary:queue"
+SUMMARY_QUEUED_TTL = 600
+# Реплики, которые еще не вошли в резюме (пары user/assistant в JSON)
+SUMMARY_PENDING_TTL = 7 * 24 * 3600
+
+SUMMARY_PROMPT = "Ты — AI-аналитик. Тебе дано предыдущее резюме пользователя (может отсутствовать) и новые реплики диалога. Составь обновленное очень краткое, но емкое резюме (на русском языке) об интересах, целях и личности пользователя, дополнив предыдущее новыми сведениями. Это резюме будет использоваться для поддержания контекста в будущих диалогах. Не здоровайся, просто дай резюме."
+
+
+def _pending_key(user_id: int) -> str:
+    return f"summary:pending:{user_id}"
+
+def _queued_key(user_id: int) -> str:
+    return f"summary:queued:{user_id}"
+
+@traced()
+async def get_user_memory(user_id: int, user_ctx: UserContext | None = None) -> dict:
     """
     Получает историю из Redis и summary из PostgreSQL.
+    Если передан user_ctx, summary берется из него без обращения к БД.
     Гарантированно возвращает словарь с ключами "history" (list) и "summary" (str или None).
     """
     history = []
@@ -26,6 +48,8 @@ async def get_user_memory(user_id: int) -> dict:
         history = []
 
     # 2. Пытаемся получить summary из PostgreSQL
+    if user_ctx is not None:
+        return {"history": history, "summary": user_ctx.summary}
     try:
         user_db_id_row = await db.fetchrow("SELECT id FROM users WHERE telegram_id=$1", user_id)
         if user_db_id_row:
@@ -40,37 +64,106 @@ async def get_user_memory(user_id: int) -> dict:
     return {"history": history, "summary": summary}
 
 
+@traced()
 async def update_user_memory(user_id: int, history: list, assistant_response: str):
     """
-    Обновляет историю в Redis и периодически обновляет резюме диалога в PostgreSQL.
+    Обновляет историю в Redis и отмечает новый ход диалога для резюме.
+    Каждые SUMMARY_EVERY_TURNS ходов пользователь ставится в очередь на обновление
+    резюме; само резюме считает фоновый воркер (run_summary_worker), ответ его не ждет.
     """
+    user_message = history[-1]["content"] if history and history[-1].get("role") == "user" else ""
+
     # 1. Добавляем ответ ассистента и обрезаем историю
     history.append({"role": "assistant", "content": assistant_response})
     if len(history) > MEMORY_LIMIT:
         history = history[-MEMORY_LIMIT:]
     
-    # 2. Сохраняем историю в Redis
+    # 2. Сохраняем историю в Redis и копим ход для резюме
     history_key = f"memory:{user_id}"
-    await redis_client.set(history_key, json.dumps(history), ex=3600)
+    pending_key = _pending_key(user_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.set(history_key, json.dumps(history), ex=3600)
+        pipe.rpush(pending_key, json.dumps({"user": user_message, "assistant": assistant_response}))
+        pipe.expire(pending_key, SUMMARY_PENDING_TTL)
+        _, turns, _ = await pipe.execute()
 
-    # 3. Каждые 10 сообщений (когда история заполнится) обновляем summary
-    if len(history) == MEMORY_LIMIT:
-        logger.info(f"Updating summary for user {user_id}...")
-        # Этот импорт здесь, чтобы избежать циклических зависимостей
-        from .openai_service import ask_gpt
+    # 3. Набралось достаточно новых ходов — в очередь (если пользователь уже там, второй раз не ставим)
+    if turns >= settings.SUMMARY_EVERY_TURNS:
+        if await redis_client.set(_queued_key(user_id), 1, nx=True, ex=SUMMARY_QUEUED_TTL):
+            await redis_client.rpush(SUMMARY_QUEUE_KEY, user_id)
 
-        summary_prompt = "Ты — AI-аналитик. Проанализируй предоставленный диалог и сделай очень краткое, но емкое резюме (на русском языке) об интересах, целях и личности пользователя. Это резюме будет использоваться для поддержания контекста в будущих диалогах. Не здоровайся, просто дай резюме."
-        new_summary = await ask_gpt(summary_prompt, history)
 
-        user_db_id_row = await db.fetchrow("SELECT id FROM users WHERE telegram_id=$1", user_id)
-        if user_db_id_row:
-            user_db_id = user_db_id_row['id']
-            await db.execute(
-                    """
-                    INSERT INTO user_memory (user_id, summary, updated_at) 
-                    VALUES ($1, $2, NOW()) 
-                    ON CONFLICT (user_id) DO UPDATE SET summary = EXCLUDED.summary, updated_at = NOW()
-                    """,
-                    user_db_id, new_summary
-            )
-            logger.info(f"Successfully updated summary for user {user_id}.")
+async def summarize_user(user_id: int, lock=None):
+    """
+    Обновляет резюме инкрементально: предыдущее резюме + только новые ходы.
+    lock — блокировка воркера; если она потеряна, результат не записывается.
+    """
+    # Этот импорт здесь, чтобы избежать циклических зависимостей
+    from .openai_service import ask_gpt, EMPTY_REPLY, ERROR_REPLY
+    from .llm_scheduler import PRIORITY_BACKGROUND
+
+    pending_key = _pending_key(user_id)
+    turns = [json.loads(t) for t in await redis_client.lrange(pending_key, 0, -1)]
+    if not turns:
+        return
+    row = await db.fetchrow(
+        "SELECT u.id, um.summary FROM users u LEFT JOIN user_memory um ON um.user_id = u.id WHERE u.telegram_id=$1",
+        user_id
+    )
+    if not row:
+        await redis_client.delete(pending_key)
+        return
+
+    dialog = "\n".join(f"Пользователь: {t['user']}\nАссистент: {t['assistant']}" for t in turns)
+    request = f"Предыдущее резюме:\n{row['summary'] or '(нет)'}\n\nНовые реплики:\n{dialog}"
+    logger.info(f"Updating summary for user {user_id} ({len(turns)} new turns)...")
+    new_summary = await ask_gpt(
+        SUMMARY_PROMPT,
+        [{"role": "user", "content": request}],
+        priority=PRIORITY_BACKGROUND,
+        model=settings.SUMMARY_MODEL,
+    )
+    if new_summary in (EMPTY_REPLY, ERROR_REPLY):
+        # Ходы остаются в очереди и войдут в следующую попытку
+        logger.warning(f"Summary for user {user_id} was not updated")
+        return
+    if lock is not None and lock.lost:
+        # Пока шел запрос, пользователя мог взять другой воркер — не перетираем его резюме
+        logger.warning(f"Summary lock for user {user_id} was lost, result discarded")
+        return
+
+    await db.execute(
+            """
+            INSERT INTO user_memory (user_id, summary, updated_at) 
+            VALUES ($1, $2, NOW()) 
+            ON CONFLICT (user_id) DO UPDATE SET summary = EXCLUDED.summary, updated_at = NOW()
+            """,
+            row['id'], new_summary
+    )
+    # Удаляем только учтенные ходы: пока шел запрос, могли добавиться новые
+    await redis_client.ltrim(pending_key, len(turns), -1)
+    logger.info(f"Successfully updated summary for user {user_id}.")
+
+
+async def run_summary_worker():
+    """
+    Фоновый воркер резюме. Очередь общая для всех процессов; запускать в каждом.
+    Одного пользователя одновременно обрабатывает только один воркер.
+    """
+    while True:
+        try:
+            item = await redis_client.blpop(SUMMARY_QUEUE_KEY, timeout=5)
+            if not item:
+                continue
+            user_id = int(item[1])
+            try:
+                async with job_lock(f"summary:{user_id}", ttl=120) as lock:
+                    if lock:
+                        await summarize_user(user_id, lock)
+            finally:
+                await redis_client.delete(_queued_key(user_id))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Summary worker error: {e}")
+            await asyncio.sleep(1)
@@ -1,29 +1,144 @@
+import asyncio
+import time
 import openai
+from typing import AsyncIterator
 from ..config import settings
+from .. import metrics, tracing
+from .prompt_builder import build_prompt
+from .response_cache import make_cache_key, get_cached_response, store_response
+from .llm_scheduler import (
+    llm_scheduler,
+    is_retryable,
+    retry_delay,
+    PRIORITY_DEMO,
+)
 from loguru import logger
 
-client = openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-
-async def ask_gpt(system_prompt: str, history: list, summary: str | None = None):
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    if summary:
-        messages.append({"role": "system", "content": f"Вот краткое резюме предыдущих разговоров с этим пользователем, используй его для контекста: {summary}"})
-
-    messages.extend(history)
-
-    try:
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000,
-            stream=False
-        )
-        content = response.choices[0].message.content
-        if content:
-            return content.strip()
-        return "К сожалению, я не могу дать ответ на это. Попробуйте переформулировать."
-    except Exception as e:
-        logger.error(f"Ошибка OpenAI: {e}")
-        return "Извините, произошла ошибка при обращении к AI. Попробуйте позже."
+# Повторы делает планировщик (с джиттером и с освобождением слота на время паузы)
+client = openai.AsyncOpenAI(
+    api_key=settings.OPENAI_API_KEY,
+    base_url=settings.OPENAI_BASE_URL or None,
+    max_retries=0,
+)
+
+MODEL = "gpt-4o"
+MAX_TOKENS = 1000
+
+EMPTY_REPLY = "К сожалению, я не могу дать ответ на это. Попробуйте переформулировать."
+ERROR_REPLY = "Извините, произошла ошибка при обращении к AI. Попробуйте позже."
+
+
+def _record_usage(model: str, usage):
+    metrics.OPENAI_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens)
+    metrics.OPENAI_TOKENS.labels(model, "completion").inc(usage.completion_tokens)
+
+@tracing.traced("ask_gpt")
+async def ask_gpt(
+    system_prompt: str,
+    history: list,
+    summary: str | None = None,
+    priority: int = PRIORITY_DEMO,
+    model: str = MODEL,
+    temperature: float = 0.7,
+    cacheable: bool = False,
+):
+    """
+    Ответ GPT одним куском. Детерминированные запросы (temperature=0 или cacheable=True)
+    отдаются из кэша ответов в Redis, если точно такой же запрос уже был.
+    """
+    messages, prompt_tokens = build_prompt(system_prompt, history, summary, model, MAX_TOKENS)
+    tokens = prompt_tokens + MAX_TOKENS
+
+    cache_key = None
+    if settings.RESPONSE_CACHE_ENABLED and (cacheable or temperature == 0):
+        cache_key = make_cache_key(model, {"temperature": temperature, "max_tokens": MAX_TOKENS}, messages)
+        cached = await get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+
+    for attempt in range(settings.LLM_MAX_RETRIES + 1):
+        try:
+            async with llm_scheduler.slot(priority, tokens) as slot:
+                started = time.perf_counter()
+                with tracing.span("openai.chat", model=model, attempt=attempt, prompt_tokens=prompt_tokens) as span:
+                    response = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=MAX_TOKENS,
+                        stream=False
+                    )
+                    if span is not None and response.usage:
+                        span.set("completion_tokens", response.usage.completion_tokens)
+                metrics.OPENAI_LATENCY.labels(model, "complete").observe(time.perf_counter() - started)
+                if response.usage:
+                    slot.report(response.usage.total_tokens)
+                    _record_usage(model, response.usage)
+            content = response.choices[0].message.content
+            if content:
+                if cache_key:
+                    await store_response(cache_key, content.strip())
+                return content.strip()
+            return EMPTY_REPLY
+        except Exception as e:
+            metrics.OPENAI_ERRORS.labels(model, type(e).__name__).inc()
+            if attempt < settings.LLM_MAX_RETRIES and is_retryable(e):
+                delay = retry_delay(attempt, e)
+                logger.warning(f"OpenAI: {type(e).__name__}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"Ошибка OpenAI: {e}")
+            return ERROR_REPLY
+
+async def stream_gpt(system_prompt: str, history: list, summary: str | None = None, priority: int = PRIORITY_DEMO) -> AsyncIterator[str]:
+    """
+    Потоковый вариант ask_gpt: отдает фрагменты ответа по мере генерации.
+    Слот планировщика занят, пока идет поток. Повтор возможен только до первого
+    фрагмента; если ошибка случилась до него, отдает текст ошибки,
+    иначе просто обрывает поток (уже отправленная часть ответа остается).
+    """
+    messages, prompt_tokens = build_prompt(system_prompt, history, summary, MODEL, MAX_TOKENS)
+    tokens = prompt_tokens + MAX_TOKENS
+    produced = False
+
+    for attempt in range(settings.LLM_MAX_RETRIES + 1):
+        try:
+            async with llm_scheduler.slot(priority, tokens) as slot:
+                started = time.perf_counter()
+                with tracing.span("openai.chat", activate=False, model=MODEL, stream=True, attempt=attempt, prompt_tokens=prompt_tokens) as span:
+                    stream = await client.chat.completions.create(
+                        model=MODEL,
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=MAX_TOKENS,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )
+                    async for chunk in stream:
+                        if chunk.usage:
+                            slot.report(chunk.usage.total_tokens)
+                            _record_usage(MODEL, chunk.usage)
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            if span is not None and not produced:
+                                span.set("first_token_ms", round((time.perf_counter() - started) * 1000, 3))
+                            produced = True
+                            yield delta
+                metrics.OPENAI_LATENCY.labels(MODEL, "stream").observe(time.perf_counter() - started)
+            break
+        except Exception as e:
+            metrics.OPENAI_ERRORS.labels(MODEL, type(e).__name__).inc()
+            if not produced and attempt < settings.LLM_MAX_RETRIES and is_retryable(e):
+                delay = retry_delay(attempt, e)
+                logger.warning(f"OpenAI (stream): {type(e).__name__}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"Ошибка OpenAI (stream): {e}")
+            if not produced:
+                yield ERROR_REPLY
+            return
+
+    if not produced:
+        yield EMPTY_REPLY
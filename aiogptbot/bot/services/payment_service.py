@@ -1,18 +1,53 @@
 from aiogptbot.bot.db.postgres import db
+from aiogptbot.bot.db.coordination import job_lock
 from aiogptbot.bot.config import settings
+from aiogptbot.bot import metrics
+from aiogptbot.bot.services.config_cache import get_price
 from aiogram.types import LabeledPrice
 from datetime import datetime, timedelta
 import httpx
 from aiogram import Bot
 from loguru import logger
 import asyncio
+import time
+
+CRYPTOCLOUD_API_URL = "https://api.cryptocloud.plus/v2"
+# Статусы счета CryptoCloud, при которых подписка активируется / счет закрывается
+CRYPTOCLOUD_PAID_STATUSES = ("paid", "overpaid")
+CRYPTOCLOUD_CLOSED_STATUSES = ("canceled",)
+# Счет выставлен, но не оплачен: старше CRYPTOCLOUD_INVOICE_TTL_HOURS такие закрываются
+CRYPTOCLOUD_UNPAID_STATUSES = ("created",)
+
+# Один клиент на процесс: соединения и TLS-сессии переиспользуются между запросами
+_http_client: httpx.AsyncClient | None = None
+
+# invoice_id -> (когда проверять в следующий раз, текущий интервал) для экспоненциальной паузы
+_invoice_backoff: dict[str, tuple[float, float]] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=CRYPTOCLOUD_API_URL,
+            headers={"Authorization": f"Token {settings.CRYPTOCLOUD_API_KEY}"},
+            timeout=httpx.Timeout(15.0),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
 
 
 async def create_telegram_invoice(user_id):
-    row = await db.fetchrow("SELECT value FROM prices WHERE name='premium_month_stars'")
-    if not row:
+    price_in_stars = await get_price('premium_month_stars')
+    if price_in_stars is None:
         return None, "Стоимость подписки (Stars) не установлена. Обратитесь к администратору."
-    price_in_stars = int(row['value'])
     prices = [LabeledPrice(label="Premium подписка на 1 месяц", amount=price_in_stars)]
     return {
         "user_id": user_id,
@@ -42,11 +77,9 @@ async def record_successful_telegram_payment(user_id: int, amount: int, telegram
     logger.info(f"Recorded successful payment for user_id={user_id}, amount={amount}, charge_id={telegram_payment_charge_id}")
 
 async def create_cryptocloud_invoice(user_id):
-    row = await db.fetchrow("SELECT value FROM prices WHERE name='premium_month_crypto'")
-    if not row:
+    price = await get_price('premium_month_crypto')
+    if price is None:
         return None, "Стоимость подписки (Crypto) не установлена. Обратитесь к администратору."
-    price = int(row['value'])
-    api_key = settings.CRYPTOCLOUD_API_KEY
     payload = {
         "shop_id": settings.CRYPTOCLOUD_SHOP_ID,
         "amount": price,
@@ -54,74 +87,169 @@ async def create_cryptocloud_invoice(user_id):
         "order_id": str(user_id),
         "desc": "Premium подписка на 1 месяц"
     }
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            "https://api.cryptocloud.plus/v2/invoice/create",
-            headers={"Authorization": f"Token {api_key}"},
-            json=payload
+    resp = await get_http_client().post("/invoice/create", json=payload)
+    data = resp.json()
+    if data.get("status") == "success":
+        url = data["result"]["link"]
+        invoice_id = data["result"]["uuid"]
+        user_row = await db.fetchrow("SELECT id FROM users WHERE telegram_id=$1", user_id)
+        if not user_row:
+            return None, "Пользователь не найден в базе. Попробуйте позже."
+        real_user_id = user_row["id"]
+        await db.execute(
+            "INSERT INTO payments (user_id, amount, currency, payment_method, status, created_at, invoice_id) VALUES ($1, $2, $3, 'cryptocloud', 'pending', $4, $5)",
+            real_user_id, price, "RUB", datetime.now(), invoice_id
+        )
+        return {"url": url, "invoice_id": invoice_id}, None
+    else:
+        return None, "Ошибка при создании ссылки на оплату. Попробуйте позже."
+
+async def activate_cryptocloud_payment(payment_id: int) -> int | None:
+    """
+    Переводит pending-платеж в success и активирует подписку одной транзакцией.
+    Платеж помечается первым и только если он еще pending, поэтому повторный вызов
+    (параллельный опрос, вебхук) ничего не сделает. Возвращает telegram_id
+    пользователя, если подписку активировал именно этот вызов, иначе None.
+    """
+    async with db.transaction() as conn:
+        row = await conn.fetchrow(
+            """
+            UPDATE payments p SET status='success'
+            FROM users u
+            WHERE p.id=$1 AND p.status='pending' AND u.id=p.user_id
+            RETURNING p.user_id, u.telegram_id
+            """,
+            payment_id
+        )
+        if not row:
+            return None
+        now = datetime.now()
+        until = now + timedelta(days=30)
+        await conn.execute(
+            "UPDATE users SET status='premium', subscription_until=$1 WHERE id=$2",
+            until, row["user_id"]
+        )
+        await conn.execute(
+            "INSERT INTO subscriptions (user_id, type, start_date, end_date, is_active) VALUES ($1, 'premium', $2, $3, TRUE)",
+            row["user_id"], now, until
+        )
+    return row["telegram_id"]
+
+async def _notify_activated(bot: Bot, payment_id: int):
+    telegram_id = await activate_cryptocloud_payment(payment_id)
+    if telegram_id is None:
+        return
+    logger.info(f"Подписка активирована по платежу CryptoCloud id={payment_id}, пользователь {telegram_id}")
+    try:
+        await bot.send_message(telegram_id, "Ваша подписка активирована! Спасибо за оплату через CryptoCloud. Приятного общения с AI-ботом!")
+    except Exception as e:
+        logger.warning(f"Не удалось отправить уведомление пользователю {telegram_id}: {e}")
+
+async def activate_cryptocloud_invoice(bot: Bot, invoice_id: str) -> bool:
+    """
+    Активирует подписку по номеру счета CryptoCloud (для вебхука).
+    В постбэке номер приходит без префикса INV-, в базе хранится с ним.
+    Возвращает False, если pending-платежа с таким счетом нет.
+    """
+    payment = await db.fetchrow(
+        "SELECT id FROM payments WHERE payment_method='cryptocloud' AND status='pending' AND invoice_id = ANY($1::text[])",
+        [invoice_id, f"INV-{invoice_id}"]
+    )
+    if not payment:
+        return False
+    await _notify_activated(bot, payment["id"])
+    return True
+
+async def _fetch_invoice_statuses(invoice_ids: list[str]) -> dict[str, str]:
+    """Один запрос merchant/info на пачку счетов: invoice_id -> статус."""
+    resp = await get_http_client().post("/invoice/merchant/info", json={"uuids": invoice_ids})
+    data = resp.json()
+    if data.get("status") != "success" or not isinstance(data.get("result"), list):
+        raise RuntimeError(f"merchant/info вернул {data}")
+    return {item.get("uuid"): item.get("status") for item in data["result"]}
+
+def _due_invoices(payments) -> list:
+    """Оставляет только счета, для которых прошла пауза, и забывает закрытые."""
+    now = time.monotonic()
+    pending = {p["invoice_id"] for p in payments}
+    for invoice_id in list(_invoice_backoff):
+        if invoice_id not in pending:
+            del _invoice_backoff[invoice_id]
+    return [p for p in payments if _invoice_backoff.get(p["invoice_id"], (0, 0))[0] <= now]
+
+def _postpone(invoice_id: str):
+    interval = settings.CRYPTOCLOUD_POLL_INTERVAL
+    if invoice_id in _invoice_backoff:
+        interval = min(_invoice_backoff[invoice_id][1] * 2, settings.CRYPTOCLOUD_MAX_BACKOFF)
+    _invoice_backoff[invoice_id] = (time.monotonic() + interval, interval)
+
+async def check_cryptocloud_payments(bot: Bot):
+    """
+    Один проход опроса: запрашивает статусы пачками по CRYPTOCLOUD_BATCH_SIZE,
+    параллельно активирует оплаченные и закрывает отмененные. Счет старше
+    CRYPTOCLOUD_INVOICE_TTL_HOURS закрывается только после того, как CryptoCloud
+    подтвердил, что он не оплачен: иначе оплата перед самым сроком (или пока
+    счет ждал паузы) потерялась бы.
+    """
+    # Возраст счета считает сама база: created_at — timestamptz
+    payments = await db.fetch(
+        """
+        SELECT id, invoice_id, created_at < NOW() - make_interval(hours => $1) AS stale
+        FROM payments WHERE payment_method='cryptocloud' AND status='pending' ORDER BY created_at
+        """,
+        settings.CRYPTOCLOUD_INVOICE_TTL_HOURS
+    )
+    metrics.PENDING_PAYMENTS.labels("cryptocloud").set(len(payments))
+    due = _due_invoices(payments)
+    batch_size = settings.CRYPTOCLOUD_BATCH_SIZE
+    batches = [due[i:i + batch_size] for i in range(0, len(due), batch_size)]
+    results = await asyncio.gather(
+        *(_fetch_invoice_statuses([p["invoice_id"] for p in batch]) for batch in batches),
+        return_exceptions=True
+    )
+
+    paid, closed = [], []
+    for batch, statuses in zip(batches, results):
+        if isinstance(statuses, Exception):
+            logger.warning(f"Ошибка опроса CryptoCloud ({len(batch)} счетов): {statuses}")
+            continue
+        for payment in batch:
+            status = statuses.get(payment["invoice_id"])
+            if status in CRYPTOCLOUD_PAID_STATUSES:
+                paid.append(payment["id"])
+            elif status in CRYPTOCLOUD_CLOSED_STATUSES:
+                closed.append(payment["id"])
+            elif status in CRYPTOCLOUD_UNPAID_STATUSES and payment["stale"]:
+                closed.append(payment["id"])
+            else:
+                _postpone(payment["invoice_id"])
+
+    if closed:
+        expired = await db.execute(
+            "UPDATE payments SET status='expired' WHERE id = ANY($1::int[]) AND status='pending'",
+            closed
         )
-        data = resp.json()
-        if data.get("status") == "success":
-            url = data["result"]["link"]
-            invoice_id = data["result"]["uuid"]
-            user_row = await db.fetchrow("SELECT id FROM users WHERE telegram_id=$1", user_id)
-            if not user_row:
-                return None, "Пользователь не найден в базе. Попробуйте позже."
-            real_user_id = user_row["id"]
-            await db.execute(
-                "INSERT INTO payments (user_id, amount, currency, payment_method, status, created_at, invoice_id) VALUES ($1, $2, $3, 'cryptocloud', 'pending', $4, $5)",
-                real_user_id, price, "RUB", datetime.now(), invoice_id
-            )
-            return {"url": url, "invoice_id": invoice_id}, None
-        else:
-            return None, "Ошибка при создании ссылки на оплату. Попробуйте позже."
+        logger.info(f"Отмененные и просроченные счета CryptoCloud закрыты: {expired}")
+    await asyncio.gather(*(_notify_activated(bot, payment_id) for payment_id in paid))
 
 async def poll_cryptocloud_payments(bot: Bot):
     """
     Запускать как отдельную задачу при старте бота.
-    Проверяет все pending-платежи CryptoCloud раз в 20 секунд и активирует подписку при оплате.
+    Раз в CRYPTOCLOUD_POLL_INTERVAL секунд проверяет pending-платежи CryptoCloud
+    и активирует подписку при оплате. Неоплаченные счета проверяются все реже
+    (экспоненциальная пауза до CRYPTOCLOUD_MAX_BACKOFF), старые неоплаченные закрываются.
+    Если включен вебхук, опрос только подбирает пропущенные постбэки
+    и идет раз в CRYPTOCLOUD_RECONCILE_INTERVAL секунд.
     """
+    interval = settings.CRYPTOCLOUD_POLL_INTERVAL
+    # Без секретного ключа постбэки отклоняются, так что опрос остается основным способом
+    if settings.CRYPTOCLOUD_WEBHOOK_ENABLED and settings.CRYPTOCLOUD_SECRET_KEY:
+        interval = settings.CRYPTOCLOUD_RECONCILE_INTERVAL
     while True:
-        payments = await db.fetch("SELECT * FROM payments WHERE payment_method='cryptocloud' AND status='pending'")
-        api_key = settings.CRYPTOCLOUD_API_KEY
-        for payment in payments:
-            invoice_id = payment['invoice_id']
-            user_id = payment['user_id']
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(
-                    "https://api.cryptocloud.plus/v2/invoice/merchant/info",
-                    headers={"Authorization": f"Token {api_key}"},
-                    json={"uuids": [invoice_id]}
-                )
-                data = resp.json()
-                if (
-                    data.get("status") == "success"
-                    and data.get("result")
-                    and isinstance(data["result"], list)
-                    and len(data["result"]) > 0
-                    and data["result"][0].get("status") in ["paid", "overpaid"]
-                ):
-                    # Получаем telegram_id по user_id
-                    user_row = await db.fetchrow("SELECT telegram_id FROM users WHERE id=$1", user_id)
-                    if not user_row:
-                        continue
-                    telegram_id = user_row["telegram_id"]
-                    until = datetime.now() + timedelta(days=30)
-                    await db.execute(
-                        "UPDATE users SET status='premium', subscription_until=$1 WHERE telegram_id=$2",
-                        until, telegram_id
-                    )
-                    await db.execute(
-                        "INSERT INTO subscriptions (user_id, type, start_date, end_date, is_active) VALUES ($1, 'premium', $2, $3, TRUE)",
-                        user_id, datetime.now(), until
-                    )
-                    updated = await db.execute(
-                        "UPDATE payments SET status='success' WHERE id=$1 AND status='pending'",
-                        payment['id']
-                    )
-                    if updated and (updated == 'UPDATE 1' or updated == 'UPDATE 1;'):
-                        try:
-                            await bot.send_message(telegram_id, "Ваша подписка активирована! Спасибо за оплату через CryptoCloud. Приятного общения с AI-ботом!")
-                        except Exception as e:
-                            logger.warning(f"Не удалось отправить уведомление пользователю {telegram_id}: {e}")
-        await asyncio.sleep(20) 
\ No newline at end of file
+        try:
+            async with job_lock("cryptocloud_poll") as acquired:
+                if acquired:
+                    await check_cryptocloud_payments(bot)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке платежей CryptoCloud: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,135 @@
+from functools import lru_cache
+from loguru import logger
+from ..config import settings
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken считаем приблизительно
+    tiktoken = None
+
+# Служебные токены на каждое сообщение в формате chat (роль, разделители) и на ответ
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Бюджет на один запрос (промпт + ответ) по умолчанию; переопределяется PROMPT_TOKEN_BUDGETS
+DEFAULT_TOKEN_BUDGETS = {
+    "gpt-4o": 8000,
+    "gpt-4o-mini": 8000,
+}
+FALLBACK_TOKEN_BUDGET = 8000
+
+TRUNCATION_MARK = "\n[…]\n"
+SUMMARY_PREFIX = "Вот краткое резюме предыдущих разговоров с этим пользователем, используй его для контекста: "
+# Доля бюджета, которая всегда остается последнему сообщению пользователя
+MIN_LAST_MESSAGE_SHARE = 0.25
+# Больше этой доли бюджета резюме занимает, только если история оставила место
+MAX_SUMMARY_SHARE = 0.25
+
+
+def _parse_budgets(value: str) -> dict[str, int]:
+    """"gpt-4o=8000,gpt-4o-mini=4000" -> {"gpt-4o": 8000, "gpt-4o-mini": 4000}"""
+    budgets = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        model, _, tokens = item.partition("=")
+        budgets[model.strip()] = int(tokens)
+    return budgets
+
+
+TOKEN_BUDGETS = {**DEFAULT_TOKEN_BUDGETS, **_parse_budgets(settings.PROMPT_TOKEN_BUDGETS)}
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # Словарь токенизатора скачивается при первом обращении — без сети считаем приблизительно
+        logger.warning(f"Токенизатор для {model} недоступен, используется оценка по длине: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # ~3 символа на токен для русского текста; лучше переоценить, чем упереться в лимит
+        return len(text) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _truncate(text: str, max_tokens: int, model: str) -> str:
+    """Оставляет начало и конец текста, выбрасывая середину, чтобы уложиться в max_tokens."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        keep = max_tokens * 3
+        return text if len(text) <= keep else text[:keep // 2] + TRUNCATION_MARK + text[-(keep // 2):]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    half = max_tokens // 2
+    return encoding.decode(tokens[:half]) + TRUNCATION_MARK + encoding.decode(tokens[-half:])
+
+
+def build_prompt(system_prompt: str, history: list, summary: str | None, model: str, max_tokens: int) -> tuple[list, int]:
+    """
+    Собирает сообщения для chat completions в пределах бюджета модели за вычетом max_tokens.
+    Системный промпт и последнее сообщение остаются всегда; последнему сообщению
+    резервируется не меньше MIN_LAST_MESSAGE_SHARE бюджета. Резюме заранее получает
+    не больше MAX_SUMMARY_SHARE, остальное отдается истории: старые сообщения
+    отбрасываются с начала, слишком длинное последнее сообщение обрезается посередине.
+    Затем резюме обрезается под оставшееся место.
+    Возвращает (messages, число токенов промпта).
+    """
+    limit = TOKEN_BUDGETS.get(model, FALLBACK_TOKEN_BUDGET) - max_tokens - TOKENS_PER_REPLY
+
+    def size(message: dict) -> int:
+        return count_tokens(message.get("content") or "", model) + TOKENS_PER_MESSAGE
+
+    reserve = min(size(history[-1]), int(limit * MIN_LAST_MESSAGE_SHARE)) if history else 0
+    head = [{"role": "system", "content": system_prompt}]
+    used = size(head[0])
+    if used + reserve > limit:
+        logger.warning(
+            f"Системный промпт ({used} токенов) не помещается в бюджет {model} ({limit}): "
+            f"запрос превысит бюджет"
+        )
+    summary_overhead = count_tokens(SUMMARY_PREFIX, model) + TOKENS_PER_MESSAGE
+    summary_reserve = min(count_tokens(summary, model) + summary_overhead, int(limit * MAX_SUMMARY_SHARE)) if summary else 0
+
+    kept = []
+    dropped = 0
+    history_limit = limit - summary_reserve
+    for i, message in enumerate(reversed(history)):
+        tokens = size(message)
+        if used + tokens > history_limit:
+            if i == 0:
+                # Последнее сообщение пользователя не выбрасываем — обрезаем, но не меньше резерва
+                content = _truncate(message.get("content") or "", max(history_limit - used, reserve) - TOKENS_PER_MESSAGE, model)
+                message = {**message, "content": content}
+                tokens = size(message)
+            else:
+                dropped = len(history) - i
+                break
+        kept.append(message)
+        used += tokens
+
+    if summary:
+        summary_budget = limit - used - summary_overhead
+        if summary_budget > 0:
+            head.append({"role": "system", "content": SUMMARY_PREFIX + _truncate(summary, summary_budget, model)})
+            used += size(head[-1])
+        else:
+            logger.warning(f"Резюме не помещается в бюджет {model} ({limit}) и не передается")
+
+    messages = head + kept[::-1]
+    logger.info(
+        f"Промпт {model}: {used + TOKENS_PER_REPLY} токенов, сообщений {len(messages)}"
+        + (f", отброшено старых {dropped}" if dropped else "")
+    )
+    return messages, used + TOKENS_PER_REPLY
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import time
+from loguru import logger
+from ..config import settings
+from ..db.redis_client import redis_client
+
+CACHE_KEY_PREFIX = "gptcache"
+# Ключи ответов в порядке добавления — по нему вытесняются самые старые
+CACHE_INDEX_KEY = f"{CACHE_KEY_PREFIX}:index"
+CACHE_STATS_KEY = f"{CACHE_KEY_PREFIX}:stats"
+
+
+def make_cache_key(model: str, params: dict, messages: list) -> str:
+    payload = json.dumps({"model": model, "params": params, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return f"{CACHE_KEY_PREFIX}:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+
+async def get_cached_response(key: str) -> str | None:
+    try:
+        value = await redis_client.get(key)
+        await redis_client.hincrby(CACHE_STATS_KEY, "hits" if value is not None else "misses", 1)
+        return value
+    except Exception as e:
+        logger.warning(f"Кэш ответов GPT недоступен: {e}")
+        return None
+
+
+async def store_response(key: str, response: str):
+    """Сохраняет ответ с TTL; если записей больше RESPONSE_CACHE_MAX_ENTRIES, удаляет самые старые."""
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(key, response, ex=settings.RESPONSE_CACHE_TTL)
+            pipe.zadd(CACHE_INDEX_KEY, {key: time.time()})
+            pipe.zcard(CACHE_INDEX_KEY)
+            _, _, size = await pipe.execute()
+        # Записи, истекшие по TTL, тоже убираем из индекса
+        await redis_client.zremrangebyscore(CACHE_INDEX_KEY, 0, time.time() - settings.RESPONSE_CACHE_TTL)
+        excess = size - settings.RESPONSE_CACHE_MAX_ENTRIES
+        if excess > 0:
+            evicted = [k for k, _ in await redis_client.zpopmin(CACHE_INDEX_KEY, excess)]
+            if evicted:
+                await redis_client.delete(*evicted)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить ответ GPT в кэш: {e}")
+
+
+async def purge_response_cache():
+    """Удаляет все закэшированные ответы (например, после смены активного промпта)."""
+    keys = await redis_client.zrange(CACHE_INDEX_KEY, 0, -1)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(CACHE_INDEX_KEY)
+        await pipe.execute()
+    logger.info(f"Кэш ответов GPT очищен ({len(keys)} записей)")
+
+
+async def get_cache_stats() -> dict:
+    stats = await redis_client.hgetall(CACHE_STATS_KEY)
+    return {
+        "hits": int(stats.get("hits", 0)),
+        "misses": int(stats.get("misses", 0)),
+        "entries": await redis_client.zcard(CACHE_INDEX_KEY),
+    }
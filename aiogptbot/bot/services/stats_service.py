@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
+from loguru import logger
+from ..db.postgres import db
+
+STATS_TZ = ZoneInfo("Europe/Moscow")
+
+# Активность за сутки [$2, $3): все условия — диапазоны по created_at, чтобы работали индексы
+REFRESH_DAY_QUERY = """
+    INSERT INTO daily_stats (day, dau, messages, new_users, payments, revenue_xtr, revenue_rub, updated_at)
+    SELECT $1::date, m.dau, m.messages, u.new_users, p.payments, p.revenue_xtr, p.revenue_rub, NOW()
+    FROM (
+        SELECT COUNT(DISTINCT user_id) FILTER (WHERE role='user') AS dau, COUNT(*) AS messages
+        FROM messages WHERE created_at >= $2 AND created_at < $3
+    ) m,
+    (
+        SELECT COUNT(*) AS new_users FROM users WHERE created_at >= $2 AND created_at < $3
+    ) u,
+    (
+        SELECT COUNT(*) AS payments,
+               COALESCE(SUM(amount) FILTER (WHERE currency='XTR'), 0) AS revenue_xtr,
+               COALESCE(SUM(amount) FILTER (WHERE currency='RUB'), 0) AS revenue_rub
+        FROM payments WHERE status='success' AND created_at >= $2 AND created_at < $3
+    ) p
+    ON CONFLICT (day) DO UPDATE SET
+        dau=EXCLUDED.dau, messages=EXCLUDED.messages, new_users=EXCLUDED.new_users,
+        payments=EXCLUDED.payments, revenue_xtr=EXCLUDED.revenue_xtr, revenue_rub=EXCLUDED.revenue_rub,
+        updated_at=NOW()
+"""
+
+# Снимок текущего состояния базы пользователей — хранится в строке текущих суток
+REFRESH_SNAPSHOT_QUERY = """
+    UPDATE daily_stats SET
+        total_users = s.total_users, premium_users = s.premium_users,
+        active_7d = s.active_7d, dialog_users = s.dialog_users, updated_at = NOW()
+    FROM (
+        SELECT COUNT(*) AS total_users,
+               COUNT(*) FILTER (WHERE status='premium') AS premium_users,
+               COUNT(*) FILTER (WHERE last_activity > $2) AS active_7d,
+               COUNT(*) FILTER (WHERE EXISTS (SELECT 1 FROM messages m WHERE m.user_id = users.id)) AS dialog_users
+        FROM users
+    ) s
+    WHERE day = $1
+"""
+
+# Все, что нужно /stats, одним запросом: последние N суток + сумма сообщений за всю историю
+STATS_QUERY = """
+    SELECT *, SUM(messages) OVER () AS messages_total
+    FROM daily_stats
+    ORDER BY day DESC
+    LIMIT $1
+"""
+
+
+def _day_bounds(day):
+    start = datetime.combine(day, dtime.min, tzinfo=STATS_TZ)
+    return start, start + timedelta(days=1)
+
+
+async def refresh_daily_stats():
+    """
+    Пересчитывает агрегаты за сегодня и вчера (вчерашние — чтобы дописать хвост
+    суток после полуночи) и обновляет снимок пользователей. Вызывать по расписанию.
+    """
+    now = datetime.now(STATS_TZ)
+    today = now.date()
+    for day in (today - timedelta(days=1), today):
+        start, end = _day_bounds(day)
+        await db.execute(REFRESH_DAY_QUERY, day, start, end)
+    await db.execute(REFRESH_SNAPSHOT_QUERY, today, now - timedelta(days=7))
+    logger.info("Статистика обновлена")
+
+
+def stats_today():
+    """Текущие сутки в часовом поясе статистики."""
+    return datetime.now(STATS_TZ).date()
+
+
+async def get_stats(days: int = 7):
+    """Возвращает строки daily_stats за последние days суток (новые первыми)."""
+    rows = await db.fetch(STATS_QUERY, days)
+    if not rows or rows[0]["day"] != stats_today():
+        # Таблица еще пустая (первый запуск) или строки за сегодня еще нет
+        # (полночь, планировщик не успел) — считаем сразу
+        await refresh_daily_stats()
+        rows = await db.fetch(STATS_QUERY, days)
+    return rows
@@ -1,33 +1,111 @@
 from ..db.postgres import db
+from ..db.redis_client import redis_client
+from ..tracing import traced
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Сутки для дневного лимита считаются по Москве (как и раньше в кроне сброса)
+QUOTA_TZ = ZoneInfo("Europe/Moscow")
+DAILY_LIMIT = 5
+QUOTA_KEY_PREFIX = "quota"
+
+# Атомарная проверка и инкремент дневного счетчика.
+# KEYS[1] — счетчик за текущие сутки, ARGV[1] — лимит (-1 = без лимита),
+# ARGV[2] — unix-время конца суток, когда ключ исчезнет сам.
+# Возвращает {1, count} если сообщение разрешено, {0, count} если лимит исчерпан.
+CONSUME_QUOTA_LUA = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+local limit = tonumber(ARGV[1])
+if limit >= 0 and count >= limit then
+    return {0, count}
+end
+count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+end
+return {1, count}
+"""
+_consume_quota_script = redis_client.register_script(CONSUME_QUOTA_LUA)
+
 # Проверка и обновление статуса подписки пользователя
 def get_user_status(user):
     if user['status'] == 'premium' and user['subscription_until'] and user['subscription_until'] < datetime.now():
         return 'expired'
     return user['status']
 
+@traced()
 async def check_user_subscription(user):
     if user['status'] == 'premium' and user['subscription_until'] and user['subscription_until'] < datetime.now():
         user_id = user['telegram_id']
         await db.execute("UPDATE users SET status='expired' WHERE telegram_id=$1", user_id)
-        return await db.fetchrow("SELECT * FROM users WHERE telegram_id=$1", user_id)
+        # Обновляем уже загруженную запись вместо повторного SELECT
+        user = dict(user)
+        user['status'] = 'expired'
     return user
 
-# Инкремент лимита сообщений
+# Дневной лимит сообщений: None — без ограничений
 def get_daily_limit(user):
-    return 5 if user['status'] == 'demo' else 9999
+    return DAILY_LIMIT if user['status'] in ('demo', 'expired') else None
+
+def _quota_day(now: datetime | None = None):
+    now = now or datetime.now(QUOTA_TZ)
+    day_end = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=QUOTA_TZ)
+    return now.strftime("%Y-%m-%d"), int(day_end.timestamp())
+
+def _quota_key(user_id, day: str) -> str:
+    return f"{QUOTA_KEY_PREFIX}:{day}:{user_id}"
+
+@traced()
+async def consume_daily_quota(user_id, limit: int | None):
+    """
+    Проверяет лимит и засчитывает сообщение одной атомарной операцией в Redis.
+    Возвращает (разрешено ли сообщение, счетчик за сегодня).
+    Счетчик сам обнуляется на границе суток по Москве — ключ истекает в полночь.
+    """
+    day, day_end = _quota_day()
+    allowed, count = await _consume_quota_script(
+        keys=[_quota_key(user_id, day)], args=[-1 if limit is None else limit, day_end]
+    )
+    return bool(allowed), int(count)
+
+async def get_daily_message_count(user_id) -> int:
+    day, _ = _quota_day()
+    value = await redis_client.get(_quota_key(user_id, day))
+    return int(value) if value else 0
 
-async def increment_message_count(user_id):
-    await db.execute("UPDATE users SET daily_message_count = daily_message_count + 1 WHERE telegram_id=$1", user_id)
+async def reset_daily_quota(user_id):
+    day, _ = _quota_day()
+    await redis_client.delete(_quota_key(user_id, day))
 
-# Сброс лимита сообщений (вызывать по крону)
-async def reset_daily_limits():
-    await db.execute("UPDATE users SET daily_message_count=0 WHERE status IN ('demo', 'expired')")
-    logger.info("Daily message limits have been reset for demo and expired users.")
+# Перенос счетчиков из Redis в users.daily_message_count (для CSV и внешних отчетов).
+# Вызывать периодически; обновляет только строки, у которых значение изменилось.
+async def reconcile_daily_counts():
+    day, _ = _quota_day()
+    keys = [key async for key in redis_client.scan_iter(match=_quota_key("*", day), count=1000)]
+    counts = {}
+    for i in range(0, len(keys), 1000):
+        chunk = keys[i:i + 1000]
+        for key, value in zip(chunk, await redis_client.mget(chunk)):
+            if value is not None:
+                counts[int(key.rsplit(":", 1)[1])] = int(value)
+    telegram_ids = list(counts.keys())
+    await db.execute(
+        """
+        UPDATE users u SET daily_message_count = v.cnt
+        FROM unnest($1::bigint[], $2::int[]) AS v(telegram_id, cnt)
+        WHERE u.telegram_id = v.telegram_id AND u.daily_message_count IS DISTINCT FROM v.cnt
+        """,
+        telegram_ids, list(counts.values())
+    )
+    # Вчерашние счетчики: обнуляем только тех, у кого значение еще не ноль
+    await db.execute(
+        "UPDATE users SET daily_message_count=0 WHERE daily_message_count <> 0 AND telegram_id <> ALL($1::bigint[])",
+        telegram_ids
+    )
+    logger.info(f"Daily message counts reconciled for {len(telegram_ids)} users.")
 
 # Получить инфо о подписке
 async def get_subscription_info(user_id):
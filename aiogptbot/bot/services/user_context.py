@@ -0,0 +1,40 @@
+from dataclasses import dataclass
+from ..db.postgres import db
+from .config_cache import get_active_prompt
+from ..tracing import traced
+
+# Пользователь и его summary — одним запросом; активный промпт берется из кэша настроек
+USER_CONTEXT_QUERY = """
+    SELECT u.*, um.summary AS memory_summary
+    FROM users u
+    LEFT JOIN user_memory um ON um.user_id = u.id
+    WHERE u.telegram_id=$1
+"""
+
+
+@dataclass
+class UserContext:
+    """
+    Данные пользователя на время обработки одного апдейта.
+    Загружается в UserContextMiddleware и передается в хендлеры через data["user_ctx"],
+    чтобы middleware, хендлеры и сервисы не перечитывали одно и то же из БД.
+    """
+    telegram_id: int
+    user: dict | None = None
+    summary: str | None = None
+    system_prompt: str | None = None
+
+    @property
+    def user_db_id(self) -> int | None:
+        return self.user['id'] if self.user else None
+
+
+@traced()
+async def load_user_context(telegram_id: int) -> UserContext:
+    row = await db.fetchrow(USER_CONTEXT_QUERY, telegram_id)
+    if not row:
+        return UserContext(telegram_id=telegram_id)
+    user = dict(row)
+    summary = user.pop('memory_summary', None)
+    system_prompt = await get_active_prompt()
+    return UserContext(telegram_id=telegram_id, user=user, summary=summary, system_prompt=system_prompt)
@@ -0,0 +1,250 @@
+"""
+Трассировка обработки апдейтов в духе OpenTelemetry.
+
+На каждый апдейт Telegram создается корневой спан (TracingMiddleware), внутри —
+дочерние спаны для запросов к Postgres, команд Redis, запросов к OpenAI и вызовов
+Bot API. Текущий спан хранится в contextvars, поэтому спаны сами выстраиваются
+в дерево, в том числе через asyncio-задачи, запущенные из обработчика.
+
+Решение о сохранении принимается по завершении апдейта (tail sampling): медленные
+(дольше TRACE_SLOW_THRESHOLD) и завершившиеся ошибкой трассы сохраняются всегда,
+остальные — с вероятностью TRACE_SAMPLE_RATE. Экспорт — в JSON-файл (по трассе
+на строку) или в OTLP/HTTP коллектор (TRACE_EXPORT=file|otlp); по умолчанию выключено.
+"""
+import asyncio
+import functools
+import json
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import httpx
+from loguru import logger
+from .config import settings
+
+ENABLED = settings.TRACE_EXPORT in ("file", "otlp")
+
+EXPORT_INTERVAL = 5          # сек. между выгрузками накопленных трасс
+MAX_PENDING_TRACES = 1000    # если экспорт не успевает, лишние трассы отбрасываются
+MAX_SPANS_PER_TRACE = 500
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start_ns: int
+    attributes: dict = field(default_factory=dict)
+    end_ns: int = 0
+    error: str | None = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            **({"error": self.error} if self.error else {}),
+        }
+
+
+@dataclass
+class Trace:
+    trace_id: str
+    spans: list[Span] = field(default_factory=list)
+    finished: bool = False
+    has_error: bool = False
+
+    def add(self, span: Span):
+        # Спаны, закончившиеся после корневого (фоновые задачи апдейта), не попадают в экспорт
+        if self.finished or len(self.spans) >= MAX_SPANS_PER_TRACE:
+            return
+        self.spans.append(span)
+        self.has_error = self.has_error or span.error is not None
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+_pending: list[tuple[Trace, Span]] = []
+_exporter_task: asyncio.Task | None = None
+_http_client: httpx.AsyncClient | None = None
+
+
+def current_span() -> Span | None:
+    return _current_span.get() if _current_trace.get() is not None else None
+
+
+@contextmanager
+def span(name: str, activate: bool = True, **attributes):
+    """
+    Дочерний спан текущей трассы. Вне трассы (фоновые задачи, выключенный экспорт) ничего не делает.
+    activate=False — спан не становится текущим: для асинхронных генераторов, где между
+    yield выполняется код вызывающего, который иначе попал бы в дочерние спаны.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    current = Span(name, trace.trace_id, secrets.token_hex(8), parent.span_id if parent else None, time.time_ns(), attributes)
+    token = _current_span.set(current) if activate else None
+    try:
+        yield current
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        if token is not None:
+            _current_span.reset(token)
+        trace.add(current)
+
+
+@contextmanager
+def root_span(name: str, **attributes):
+    """Начинает новую трассу; по ее завершении решает, сохранять ли ее."""
+    if not ENABLED:
+        yield None
+        return
+    trace = Trace(secrets.token_hex(16))
+    trace_token = _current_trace.set(trace)
+    root = None
+    try:
+        with span(name, **attributes) as root:
+            yield root
+    finally:
+        _current_trace.reset(trace_token)
+        trace.finished = True
+        if root is not None and _should_keep(trace, root):
+            if len(_pending) < MAX_PENDING_TRACES:
+                _pending.append((trace, root))
+
+
+def traced(name: str | None = None):
+    """Декоратор для корутин: вызов оборачивается в спан. При выключенной трассировке функция не меняется."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _should_keep(trace: Trace, root: Span) -> bool:
+    if trace.has_error or root.duration >= settings.TRACE_SLOW_THRESHOLD:
+        return True
+    return random.random() < settings.TRACE_SAMPLE_RATE
+
+
+def _write_file(batch: list[tuple[Trace, Span]]):
+    with open(settings.TRACE_FILE, "a", encoding="utf-8") as f:
+        for trace, root in batch:
+            f.write(json.dumps({
+                "trace_id": trace.trace_id,
+                "name": root.name,
+                "duration_ms": round(root.duration * 1000, 3),
+                "error": trace.has_error,
+                "spans": [s.to_dict() for s in sorted(trace.spans, key=lambda s: s.start_ns)],
+            }, ensure_ascii=False, default=str) + "\n")
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(s: Span) -> dict:
+    result = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.parent_id:
+        result["parentSpanId"] = s.parent_id
+    return result
+
+
+async def _post_otlp(batch: list[tuple[Trace, Span]]):
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=10)
+    payload = {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": settings.TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "aiogptbot.tracing"},
+            "spans": [_otlp_span(s) for trace, _ in batch for s in trace.spans],
+        }],
+    }]}
+    response = await _http_client.post(settings.TRACE_OTLP_ENDPOINT, json=payload)
+    response.raise_for_status()
+
+
+async def flush_traces():
+    if not _pending:
+        return
+    batch = _pending[:]
+    _pending.clear()
+    try:
+        if settings.TRACE_EXPORT == "file":
+            await asyncio.to_thread(_write_file, batch)
+        else:
+            await _post_otlp(batch)
+    except Exception as e:
+        logger.warning(f"Не удалось выгрузить трассы ({len(batch)}): {e}")
+
+
+async def _export_loop():
+    while True:
+        await asyncio.sleep(EXPORT_INTERVAL)
+        await flush_traces()
+
+
+def start_tracing():
+    global _exporter_task
+    if not ENABLED or _exporter_task is not None:
+        return
+    _exporter_task = asyncio.create_task(_export_loop())
+    target = settings.TRACE_FILE if settings.TRACE_EXPORT == "file" else settings.TRACE_OTLP_ENDPOINT
+    logger.info(f"Трассировка включена: {settings.TRACE_EXPORT} -> {target}")
+
+
+async def stop_tracing():
+    global _exporter_task, _http_client
+    if _exporter_task is None:
+        return
+    _exporter_task.cancel()
+    await asyncio.gather(_exporter_task, return_exceptions=True)
+    _exporter_task = None
+    await flush_traces()
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -1,22 +1,39 @@
-import csv
-import io
+import gzip
+import os
+import tempfile
+from datetime import date, timedelta
 from ..db.postgres import db
 
-async def export_users_csv():
-    rows = await db.fetch("SELECT telegram_id, username, full_name, status, subscription_until, daily_message_count, last_activity, is_banned, created_at FROM users")
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["telegram_id", "username", "full_name", "status", "subscription_until", "daily_message_count", "last_activity", "is_banned", "created_at"])
-    for r in rows:
-        writer.writerow([
-            r['telegram_id'],
-            r['username'],
-            r['full_name'],
-            r['status'],
-            r['subscription_until'],
-            r['daily_message_count'],
-            r['last_activity'],
-            r['is_banned'],
-            r['created_at']
-        ])
-    return output.getvalue().encode("utf-8") 
\ No newline at end of file
+EXPORT_COLUMNS = ["telegram_id", "username", "full_name", "status", "subscription_until", "daily_message_count", "last_activity", "is_banned", "created_at"]
+
+async def export_users_csv(status: str | None = None, date_from: date | None = None, date_to: date | None = None) -> str:
+    """
+    Выгружает пользователей в CSV, сжатый gzip, и возвращает путь к временному файлу
+    (удалить его должен вызывающий). Строки идут потоком из COPY ... TO STDOUT прямо
+    в файл, поэтому память не зависит от размера таблицы.
+    Необязательные фильтры: статус и диапазон дат регистрации (включительно).
+    """
+    conditions, args = [], []
+    if status:
+        args.append(status)
+        conditions.append(f"status = ${len(args)}")
+    if date_from:
+        args.append(date_from)
+        conditions.append(f"created_at >= ${len(args)}")
+    if date_to:
+        args.append(date_to + timedelta(days=1))
+        conditions.append(f"created_at < ${len(args)}")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users {where} ORDER BY id"
+
+    fd, path = tempfile.mkstemp(suffix=".csv.gz")
+    os.close(fd)
+    try:
+        with gzip.open(path, "wb") as gz:
+            async def write_chunk(chunk: bytes):
+                gz.write(chunk)
+            await db.copy_from_query(query, *args, output=write_chunk, format="csv", header=True)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
@@ -0,0 +1,36 @@
+import asyncio
+import time
+from aiogram import Bot
+from aiogram.utils.chat_action import ChatActionSender
+
+
+class TypingPacer(ChatActionSender):
+    """
+    «Печатает…» на время подготовки ответа. Индикатор включается сразу при входе
+    и идет параллельно с работой обработчика. pace() перед отправкой сообщения
+    досыпает только max(0, target − прошедшее время): если работа заняла больше
+    target, ответ уходит без задержки. target=0 — без искусственных пауз.
+
+        async with TypingPacer(bot, chat_id, settings.REPLY_PACE_TARGET) as pacer:
+            text = await prepare_reply()
+            await pacer.pace()
+            await message.answer(text)
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, target: float = 0.0, **kwargs):
+        super().__init__(bot=bot, chat_id=chat_id, **kwargs)
+        self.target = target
+        self._started = time.monotonic()
+
+    async def __aenter__(self) -> "TypingPacer":
+        self._started = time.monotonic()
+        await super().__aenter__()
+        return self
+
+    async def pace(self, target: float | None = None):
+        """Ждет, пока с начала (или с предыдущего pace) пройдет target секунд; отсчет начинается заново."""
+        target = self.target if target is None else target
+        delay = target - (time.monotonic() - self._started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._started = time.monotonic()
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import AsyncIterator
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+from loguru import logger
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class StreamedReply:
+    """
+    Ответ, который показывается пользователю по мере генерации.
+    Первый фрагмент отправляется новым сообщением, дальше сообщение
+    редактируется не чаще, чем раз в edit_interval секунд. Если текст
+    не помещается в одно сообщение, продолжение уходит следующим.
+    """
+
+    def __init__(self, message: Message, edit_interval: float = 1.0, on_delivered=None):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.on_delivered = on_delivered  # вызывается, когда первое сообщение ушло в чат
+        self.text = ""
+        self._current: Message | None = None
+        self._offset = 0      # с какого символа self.text начинается текущее сообщение
+        self._shown = ("", False)  # что сейчас отображается в текущем сообщении
+        self._last_edit = 0.0
+
+    async def feed(self, delta: str):
+        self.text += delta
+        if self._current is None:
+            if self.text.strip():
+                await self._render()
+            return
+        if time.monotonic() - self._last_edit >= self.edit_interval:
+            await self._render()
+
+    async def finish(self) -> str:
+        if self.text.strip():
+            await self._render(final=True)
+        return self.text
+
+    async def _render(self, final: bool = False):
+        self._last_edit = time.monotonic()
+        while len(self.text) - self._offset > TELEGRAM_MESSAGE_LIMIT:
+            await self._show(self.text[self._offset:self._offset + TELEGRAM_MESSAGE_LIMIT], final=True)
+            self._offset += TELEGRAM_MESSAGE_LIMIT
+            self._current = None
+            self._shown = ("", False)
+        await self._show(self.text[self._offset:], final=final)
+
+    async def _show(self, chunk: str, final: bool):
+        if not chunk.strip() or (chunk, final) == self._shown or (not final and chunk == self._shown[0]):
+            return
+        # Промежуточные версии отправляем без разметки: незакрытый тег в середине
+        # генерации ломает HTML-парсинг. Финальный текст — с разметкой по умолчанию.
+        try:
+            if final:
+                try:
+                    await self._send_or_edit(chunk)
+                except TelegramBadRequest as e:
+                    if _is_not_modified(e):
+                        raise
+                    await self._send_or_edit(chunk, parse_mode=None)
+            else:
+                await self._send_or_edit(chunk, parse_mode=None)
+        except TelegramRetryAfter as e:
+            # Промежуточное редактирование можно пропустить, финальное — нет
+            if not final:
+                logger.debug(f"Edit throttled by Telegram, retry after {e.retry_after}s")
+                return
+            await asyncio.sleep(e.retry_after)
+            await self._send_or_edit(chunk, parse_mode=None)
+        except TelegramBadRequest as e:
+            if not _is_not_modified(e):
+                logger.warning(f"Не удалось обновить потоковый ответ: {e}")
+                return
+        self._shown = (chunk, final)
+
+    async def _send_or_edit(self, chunk: str, **kwargs):
+        if self._current is None:
+            self._current = await self.message.answer(chunk, **kwargs)
+            if self.on_delivered is not None:
+                self.on_delivered()
+        else:
+            await self._current.edit_text(chunk, **kwargs)
+
+
+def _is_not_modified(error: TelegramBadRequest) -> bool:
+    return "message is not modified" in str(error)
+
+
+async def send_streamed_reply(message: Message, deltas: AsyncIterator[str], edit_interval: float = 1.0, on_delivered=None) -> str:
+    """Показывает поток фрагментов ответа в чате и возвращает полный текст."""
+    reply = StreamedReply(message, edit_interval=edit_interval, on_delivered=on_delivered)
+    async for delta in deltas:
+        await reply.feed(delta)
+    return await reply.finish()
@@ -0,0 +1,64 @@
+"""Add indexes for hot lookups
+
+Revision ID: 0e2df49ecf15
+Revises: 4862109e3670
+Create Date: 2026-10-18 12:25:33.104877
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0e2df49ecf15'
+down_revision: Union[str, Sequence[str], None] = '4862109e3670'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (имя, таблица, колонки, условие частичного индекса)
+INDEXES = [
+    # /find_user, /ban_user, /unban_user
+    ('ix_users_username', 'users', ['username'], None),
+    # сегменты рассылок, /stats, выгрузка CSV с фильтрами
+    ('ix_users_status', 'users', ['status'], None),
+    ('ix_users_last_activity', 'users', ['last_activity'], None),
+    ('ix_users_created_at', 'users', ['created_at'], None),
+    ('ix_users_banned', 'users', ['id'], 'is_banned = TRUE'),
+    # reconcile_daily_counts обнуляет только ненулевые счетчики
+    ('ix_users_daily_count_nonzero', 'users', ['telegram_id'], 'daily_message_count <> 0'),
+    # история сообщений пользователя и суточные агрегаты
+    ('ix_messages_user_id_created_at', 'messages', ['user_id', 'created_at'], None),
+    ('ix_messages_created_at', 'messages', ['created_at'], None),
+    ('ix_payments_method_status', 'payments', ['payment_method', 'status'], None),
+    ('ix_payments_created_at', 'payments', ['created_at'], None),
+    # очередь опроса CryptoCloud
+    ('ix_payments_pending_cryptocloud', 'payments', ['created_at'], "payment_method = 'cryptocloud' AND status = 'pending'"),
+    # очередь рассылок
+    ('ix_mailings_unsent', 'mailings', ['created_at'], 'sent = FALSE'),
+    # активный промпт
+    ('ix_prompts_active', 'prompts', ['id'], 'is_active = TRUE'),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY не блокирует запись в таблицы на время построения,
+    # но не может выполняться внутри транзакции
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name, table, columns, unique=False,
+                postgresql_where=sa.text(where) if where else None,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
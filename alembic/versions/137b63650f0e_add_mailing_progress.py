@@ -0,0 +1,34 @@
+"""Add mailing progress
+
+Revision ID: 137b63650f0e
+Revises: b26bdb9beb3a
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '137b63650f0e'
+down_revision: Union[str, Sequence[str], None] = 'b26bdb9beb3a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Курсор рассылки (users.id последнего обработанного получателя) и счетчики,
+    # чтобы прерванная рассылка продолжалась с места остановки
+    op.add_column('mailings', sa.Column('last_user_id', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('mailings', sa.Column('sent_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('mailings', sa.Column('failed_count', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('mailings', 'failed_count')
+    op.drop_column('mailings', 'sent_count')
+    op.drop_column('mailings', 'last_user_id')
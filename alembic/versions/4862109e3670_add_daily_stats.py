@@ -0,0 +1,70 @@
+"""Add daily_stats rollup table
+
+Revision ID: 4862109e3670
+Revises: 137b63650f0e
+Create Date: 2026-10-18 11:40:07.552981
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4862109e3670'
+down_revision: Union[str, Sequence[str], None] = '137b63650f0e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('daily_stats',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('dau', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('messages', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('new_users', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('payments', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('revenue_xtr', sa.Numeric(precision=12, scale=2), server_default='0', nullable=False),
+    sa.Column('revenue_rub', sa.Numeric(precision=12, scale=2), server_default='0', nullable=False),
+    sa.Column('total_users', sa.Integer(), nullable=True),
+    sa.Column('premium_users', sa.Integer(), nullable=True),
+    sa.Column('active_7d', sa.Integer(), nullable=True),
+    sa.Column('dialog_users', sa.Integer(), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('day')
+    )
+    # Заполняем историю по уже накопленным данным (сутки — по Москве)
+    op.execute("""
+        INSERT INTO daily_stats (day, dau, messages, new_users, payments, revenue_xtr, revenue_rub)
+        SELECT d.day,
+               COALESCE(m.dau, 0), COALESCE(m.messages, 0), COALESCE(u.new_users, 0),
+               COALESCE(p.payments, 0), COALESCE(p.revenue_xtr, 0), COALESCE(p.revenue_rub, 0)
+        FROM (
+            SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date AS day FROM messages
+            UNION SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date FROM users WHERE created_at IS NOT NULL
+            UNION SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date FROM payments WHERE status='success'
+        ) d
+        LEFT JOIN (
+            SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
+                   COUNT(DISTINCT user_id) FILTER (WHERE role='user') AS dau, COUNT(*) AS messages
+            FROM messages GROUP BY 1
+        ) m ON m.day = d.day
+        LEFT JOIN (
+            SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date AS day, COUNT(*) AS new_users
+            FROM users GROUP BY 1
+        ) u ON u.day = d.day
+        LEFT JOIN (
+            SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date AS day, COUNT(*) AS payments,
+                   SUM(amount) FILTER (WHERE currency='XTR') AS revenue_xtr,
+                   SUM(amount) FILTER (WHERE currency='RUB') AS revenue_rub
+            FROM payments WHERE status='success' GROUP BY 1
+        ) p ON p.day = d.day
+        WHERE d.day IS NOT NULL
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_stats')
@@ -0,0 +1,111 @@
+"""
+Заглушка OpenAI Chat Completions для нагрузочного тестирования.
+
+POST /v1/chat/completions отвечает фиксированным текстом после задержки latency
+(время до первого токена); текст выдается chunks фрагментами с паузой chunk_delay,
+в том числе потоком (SSE, stream=true, с usage при stream_options.include_usage).
+Доля error_rate запросов получает 429 с Retry-After — для проверки повторов.
+Бот подключается к ней через OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+# Маркер конца ответа: по нему драйвер понимает, что поток дописан до конца
+END_MARK = "[конец]"
+
+WORDS = "Я понимаю тебя и очень ценю, что ты делишься этим со мной. Давай разберемся вместе, что сейчас важнее всего".split()
+
+
+@dataclass
+class FakeOpenAI:
+    latency: float = 0.5
+    chunks: int = 20
+    chunk_delay: float = 0.05
+    error_rate: float = 0.0
+    counts: Counter = field(default_factory=Counter)
+    in_flight: int = 0
+    max_in_flight: int = 0
+
+    def _pieces(self) -> list[str]:
+        words = [WORDS[i % len(WORDS)] for i in range(self.chunks)]
+        pieces = [word + " " for word in words]
+        pieces.append(END_MARK)
+        return pieces
+
+    @staticmethod
+    def _usage(body: dict, completion_tokens: int) -> dict:
+        prompt_tokens = sum(len(str(m.get("content") or "")) // 3 + 4 for m in body.get("messages", []))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.counts["requests"] += 1
+        if self.error_rate and random.random() < self.error_rate:
+            self.counts["429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"Retry-After": "1"},
+            )
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if body.get("stream"):
+                return await self._stream(request, body)
+            await asyncio.sleep(self.chunk_delay * self.chunks)
+            pieces = self._pieces()
+            return web.json_response({
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4o"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(pieces)},
+                    "finish_reason": "stop",
+                }],
+                "usage": self._usage(body, len(pieces)),
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, body: dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model", "gpt-4o")}
+
+        async def send(chunk: dict):
+            await response.write(f"data: {json.dumps({**base, **chunk}, ensure_ascii=False)}\n\n".encode())
+
+        pieces = self._pieces()
+        await send({"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            await send({"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+        await send({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send({"choices": [], "usage": self._usage(body, len(pieces))})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def create_app(fake: FakeOpenAI) -> web.Application:
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", fake.handle)
+    return app
@@ -0,0 +1,227 @@
+"""
+Заглушка Telegram Bot API для нагрузочного тестирования.
+
+Отдает боту обновления через getUpdates (long polling) и принимает его вызовы
+(sendMessage, editMessageText, sendChatAction, sendInvoice, answerCallbackQuery и т.д.),
+запоминая их по чатам, чтобы драйвер мог дождаться ответа и замерить задержку.
+Бот подключается к ней через TELEGRAM_API_URL=http://127.0.0.1:<port>.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Методы, которые сообщают пользователю что-то видимое — по ним считается задержка ответа
+REPLY_METHODS = {"sendMessage", "sendInvoice"}
+
+
+@dataclass
+class BotCall:
+    """Один вызов Bot API, сделанный ботом."""
+    at: float
+    method: str
+    params: dict
+
+    @property
+    def text(self) -> str:
+        return self.params.get("text") or self.params.get("title") or ""
+
+    @property
+    def callback_data(self) -> list[str]:
+        markup = self.params.get("reply_markup")
+        if not markup:
+            return []
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        rows = markup.get("inline_keyboard") or []
+        return [button.get("callback_data") for row in rows for button in row if button.get("callback_data")]
+
+
+@dataclass
+class ChatLog:
+    calls: list[BotCall] = field(default_factory=list)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.updates: list[dict] = []
+        self.has_updates = asyncio.Event()
+        self.polling_started = asyncio.Event()
+        self.chats: dict[int, ChatLog] = defaultdict(ChatLog)
+        self.method_counts: Counter = Counter()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        # id pre_checkout_query -> пользователь, чтобы отнести ответ бота к чату
+        self._pre_checkout_users: dict[str, int] = {}
+
+    # --- Сторона пользователя (драйвер) ---
+
+    def _push(self, kind: str, payload: dict) -> float:
+        self.updates.append({"update_id": next(self._update_ids), kind: payload})
+        self.has_updates.set()
+        return time.monotonic()
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}", "language_code": "ru"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }
+
+    def send_text(self, user_id: int, text: str) -> float:
+        """Пользователь пишет боту. Возвращает время отправки (time.monotonic)."""
+        fields = {"text": text}
+        if text.startswith("/"):
+            command = text.split()[0]
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return self._push("message", self._message(user_id, **fields))
+
+    def press_button(self, user_id: int, data: str) -> float:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": BOT_USER,
+            "text": "…",
+        }
+        return self._push("callback_query", {
+            "id": f"cb-{user_id}-{next(self._update_ids)}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        })
+
+    def pre_checkout(self, user_id: int, payload: str, amount: int) -> float:
+        query_id = f"pcq-{user_id}-{next(self._update_ids)}"
+        self._pre_checkout_users[query_id] = user_id
+        return self._push("pre_checkout_query", {
+            "id": query_id,
+            "from": self._user(user_id),
+            "currency": "XTR",
+            "total_amount": amount,
+            "invoice_payload": payload,
+        })
+
+    def successful_payment(self, user_id: int, payload: str, amount: int) -> float:
+        return self._push("message", self._message(user_id, successful_payment={
+            "currency": "XTR",
+            "total_amount": amount,
+            "invoice_payload": payload,
+            "telegram_payment_charge_id": f"bench-{user_id}-{next(self._update_ids)}",
+            "provider_payment_charge_id": "",
+        }))
+
+    def mark(self, user_id: int) -> int:
+        """Позиция в журнале чата, после которой ждать следующих ответов."""
+        return len(self.chats[user_id].calls)
+
+    async def wait_for(self, user_id: int, since: int, predicate, timeout: float) -> BotCall:
+        """Ждет вызова бота в чате user_id (после позиции since), подходящего под predicate."""
+        log = self.chats[user_id]
+        deadline = time.monotonic() + timeout
+        position = since
+        while True:
+            while position < len(log.calls):
+                call = log.calls[position]
+                position += 1
+                if predicate(call):
+                    return call
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"chat {user_id}: ответ не пришел за {timeout} с")
+            log.changed.clear()
+            try:
+                await asyncio.wait_for(log.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def first_reply_at(self, user_id: int, since: int) -> float | None:
+        for call in self.chats[user_id].calls[since:]:
+            if call.method in REPLY_METHODS:
+                return call.at
+        return None
+
+    # --- Сторона бота (HTTP) ---
+
+    def _record(self, chat_id, method: str, params: dict):
+        if chat_id is None:
+            return
+        log = self.chats[int(chat_id)]
+        log.calls.append(BotCall(time.monotonic(), method, params))
+        log.changed.set()
+
+    def _sent_message(self, params: dict, **fields) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    async def get_updates(self, params: dict):
+        self.polling_started.set()
+        offset = int(params.get("offset") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.has_updates.clear()
+            try:
+                await asyncio.wait_for(self.has_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self.updates[:limit]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.content_type != "application/json" else await request.json()
+        self.method_counts[method] += 1
+
+        if method == "getUpdates":
+            result = await self.get_updates(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method == "sendMessage":
+            self._record(params.get("chat_id"), method, params)
+            result = self._sent_message(params, text=params.get("text", ""))
+        elif method == "editMessageText":
+            self._record(params.get("chat_id"), method, params)
+            result = self._sent_message(params, message_id=int(params.get("message_id") or 0), text=params.get("text", ""))
+        elif method == "sendInvoice":
+            self._record(params.get("chat_id"), method, params)
+            result = self._sent_message(params, invoice={
+                "title": params.get("title", ""),
+                "description": params.get("description", ""),
+                "start_parameter": params.get("start_parameter", ""),
+                "currency": params.get("currency", "XTR"),
+                "total_amount": sum(p["amount"] for p in json.loads(params.get("prices") or "[]")),
+            })
+        elif method == "answerPreCheckoutQuery":
+            self._record(self._pre_checkout_users.pop(params.get("pre_checkout_query_id"), None), method, params)
+            result = True
+        else:
+            # sendChatAction, answerCallbackQuery, setMyCommands, deleteWebhook и прочие
+            self._record(params.get("chat_id"), method, params)
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+def create_app(fake: FakeTelegram) -> web.Application:
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", fake.handle)
+    return app
@@ -0,0 +1,204 @@
+"""
+Аудит планов запросов.
+
+Собирает все SQL-строки из кода aiogptbot, выполняет для каждой
+EXPLAIN (ANALYZE, FORMAT JSON) в транзакции, которая затем откатывается,
+и падает с кодом 1, если запрос читает большую таблицу последовательным
+сканированием (Seq Scan по таблице больше --threshold строк).
+
+Запускать против отдельной тестовой БД с примененными миграциями:
+
+    POSTGRES_DSN=postgresql://... REDIS_DSN=redis://... python scripts/explain_audit.py --seed 100000
+
+REDIS_DSN нужен только потому, что модули сервисов (откуда берутся динамические
+запросы) создают клиент Redis при импорте; подключения к Redis не происходит.
+--seed заполняет БД синтетическими данными (только для пустой тестовой БД!).
+--strict считает ошибкой и запросы, для которых EXPLAIN не выполнился
+(без него они только печатаются как SKIP); make audit-queries запускает со --strict.
+"""
+import argparse
+import ast
+import asyncio
+import json
+import os
+import sys
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+
+import asyncpg
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+SQL_PREFIXES = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# Запросы, которым полный проход по таблице нужен по смыслу (агрегаты по всей таблице
+# и т.п.): подстрока запроса -> таблицы, где Seq Scan допустим
+ALLOWED_SEQ_SCANS = {
+    "COUNT(*) AS total_users": {"users"},
+    "UPDATE users SET daily_message_count=0": {"users"},
+    "FROM users ORDER BY id": {"users"},
+}
+
+# Запросы, которые собираются динамически и поэтому не видны как строковые константы
+def dynamic_queries() -> list[tuple[str, str]]:
+    from aiogptbot.bot.services.mailing_service import SEGMENT_FILTERS
+    from aiogptbot.bot.utils.csv_export import EXPORT_COLUMNS
+
+    queries = [
+        (
+            f"mailing_service.iter_recipients[{segment}]",
+            f"SELECT id, telegram_id FROM users WHERE {condition} "
+            "AND id > $1 AND telegram_id <> ALL($2::bigint[]) ORDER BY id LIMIT $3",
+        )
+        for segment, condition in SEGMENT_FILTERS.items()
+    ]
+    queries.append((
+        "csv_export.export_users_csv[status]",
+        f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users WHERE status = $1 ORDER BY id",
+    ))
+    return queries
+
+
+SEED_SQL = """
+    INSERT INTO users (telegram_id, username, full_name, status, daily_message_count, is_banned,
+                       onboarding_completed, created_at, last_activity)
+    SELECT 1000000 + g, 'user' || g, 'User ' || g,
+           (ARRAY['demo', 'premium', 'expired'])[1 + g % 3], g % 6, g % 50 = 0, TRUE,
+           NOW() - (g % 365) * INTERVAL '1 day', NOW() - (g % 30) * INTERVAL '1 day'
+    FROM generate_series(1, $1) AS g;
+
+    INSERT INTO messages (user_id, role, content, created_at)
+    SELECT u.id, (ARRAY['user', 'assistant'])[1 + g % 2], 'message ' || g, NOW() - (g % 90) * INTERVAL '1 hour'
+    FROM generate_series(1, $1 * 10) AS g
+    JOIN users u ON u.telegram_id = 1000000 + 1 + g % $1;
+
+    INSERT INTO payments (user_id, amount, currency, payment_method, status, invoice_id, created_at)
+    SELECT u.id, 100, 'RUB', (ARRAY['stars', 'cryptocloud'])[1 + g % 2],
+           (ARRAY['success', 'pending', 'expired'])[1 + g % 3], 'INV-SEED-' || g, NOW() - (g % 60) * INTERVAL '1 day'
+    FROM generate_series(1, $1 / 10) AS g
+    JOIN users u ON u.telegram_id = 1000000 + 1 + g % $1;
+
+    INSERT INTO user_memory (user_id, summary)
+    SELECT id, 'summary' FROM users WHERE telegram_id > 1000000 AND telegram_id % 4 = 0
+    ON CONFLICT (user_id) DO NOTHING;
+"""
+
+
+def collect_queries() -> list[tuple[str, str]]:
+    """Находит в коде строковые константы, похожие на SQL-запросы."""
+    queries = []
+    for path in sorted((ROOT / "aiogptbot").rglob("*.py")):
+        tree = ast.parse(path.read_text(encoding="utf-8"))
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                sql = " ".join(node.value.split())
+                if sql.upper().startswith(SQL_PREFIXES) and (" FROM " in sql.upper() or " SET " in sql.upper() or "INTO" in sql.upper()):
+                    queries.append((f"{path.relative_to(ROOT)}:{node.lineno}", sql))
+    queries.extend(dynamic_queries())
+    seen, unique = set(), []
+    for location, sql in queries:
+        if sql not in seen:
+            seen.add(sql)
+            unique.append((location, sql))
+    return unique
+
+
+def sample_value(type_name: str):
+    """Подставляемое значение параметра по имени типа PostgreSQL."""
+    if type_name.startswith("_"):
+        return [sample_value(type_name[1:])]
+    if type_name in ("int2", "int4", "int8"):
+        return 1
+    if type_name in ("float4", "float8"):
+        return 1.0
+    if type_name == "numeric":
+        return Decimal(1)
+    if type_name == "bool":
+        return False
+    if type_name in ("timestamptz", "timestamp"):
+        return datetime.now(timezone.utc)
+    if type_name == "date":
+        return date.today()
+    return "x"
+
+
+def seq_scans(plan: dict):
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+async def table_sizes(conn) -> dict[str, float]:
+    rows = await conn.fetch(
+        "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace"
+    )
+    return {r["relname"]: r["reltuples"] for r in rows}
+
+
+async def audit(dsn: str, threshold: int, seed: int | None, strict: bool = False) -> int:
+    conn = await asyncpg.connect(dsn)
+    try:
+        if seed:
+            print(f"Заполнение тестовыми данными: {seed} пользователей...")
+            for statement in filter(str.strip, SEED_SQL.split(";")):
+                await conn.execute(statement, seed) if "$1" in statement else await conn.execute(statement)
+            await conn.execute("ANALYZE")
+        sizes = await table_sizes(conn)
+
+        failures = 0
+        for location, sql in collect_queries():
+            tr = conn.transaction()
+            await tr.start()
+            try:
+                statement = await conn.prepare(sql)
+                args = [sample_value(t.name) for t in statement.get_parameters()]
+                result = await conn.fetchval(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}", *args)
+                plan = json.loads(result)[0]["Plan"]
+            except Exception as e:
+                if strict:
+                    failures += 1
+                    print(f"ERROR {location}: {type(e).__name__}: {e}\n      {sql}")
+                else:
+                    print(f"SKIP  {location}: {type(e).__name__}: {e}")
+                continue
+            finally:
+                await tr.rollback()
+
+            allowed = set().union(*(t for marker, t in ALLOWED_SEQ_SCANS.items() if marker in sql))
+            bad = sorted({
+                table for table in seq_scans(plan)
+                if table and sizes.get(table, 0) >= threshold and table not in allowed
+            })
+            if bad:
+                failures += 1
+                print(f"FAIL  {location}: Seq Scan по {', '.join(bad)}\n      {sql}")
+            else:
+                print(f"OK    {location}")
+        return failures
+    finally:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", default=os.getenv("POSTGRES_DSN", ""), help="строка подключения (по умолчанию POSTGRES_DSN)")
+    parser.add_argument("--threshold", type=int, default=10000, help="Seq Scan по таблице с числом строк не меньше порога считается ошибкой")
+    parser.add_argument("--seed", type=int, default=None, help="заполнить БД N синтетическими пользователями перед аудитом")
+    parser.add_argument("--strict", action="store_true", help="считать ошибкой запросы, для которых EXPLAIN не выполнился")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("не задан POSTGRES_DSN / --dsn")
+
+    failures = asyncio.run(audit(args.dsn, args.threshold, args.seed, args.strict))
+    if failures:
+        print(f"\n{failures} запрос(ов) с последовательным сканированием больших таблиц"
+              + (" или ошибкой EXPLAIN" if args.strict else ""))
+        sys.exit(1)
+    print("\nВсе запросы используют индексы")
+
+
+if __name__ == "__main__":
+    main()
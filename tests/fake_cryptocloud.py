@@ -0,0 +1,114 @@
+"""
+Заглушки для тестов оплаты CryptoCloud: API счетов (invoice/merchant/info),
+подпись постбэков, таблица платежей в памяти и бот, который только запоминает сообщения.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def sign_postback_token(invoice_id: str, secret: str, ttl: float = 3600) -> str:
+    """JWT (HS256), как в постбэке CryptoCloud: в нагрузке номер счета и срок действия."""
+    header = _b64encode(json.dumps({"alg": "HS256", "typ": "JWT"}).encode())
+    payload = _b64encode(json.dumps({"id": invoice_id, "exp": int(time.time() + ttl)}).encode())
+    signature = hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
+    return f"{header}.{payload}.{_b64encode(signature)}"
+
+
+@dataclass
+class FakeCryptoCloud:
+    """POST /invoice/merchant/info: статусы счетов из statuses (неизвестные счета не возвращаются)."""
+    statuses: dict[str, str] = field(default_factory=dict)
+    requests: list[list[str]] = field(default_factory=list)
+
+    async def merchant_info(self, request: web.Request) -> web.Response:
+        uuids = (await request.json())["uuids"]
+        self.requests.append(uuids)
+        return web.json_response({
+            "status": "success",
+            "result": [{"uuid": uuid, "status": self.statuses[uuid]} for uuid in uuids if uuid in self.statuses],
+        })
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/invoice/merchant/info", self.merchant_info)
+        return app
+
+
+@dataclass
+class FakePayments:
+    """
+    Таблица payments в памяти вместо Postgres. Перевод pending -> success, как и
+    UPDATE ... WHERE status='pending' в базе, срабатывает только один раз.
+    """
+    rows: dict[int, dict] = field(default_factory=dict)
+
+    def add(self, invoice_id: str, telegram_id: int, created_at: datetime | None = None) -> int:
+        # created_at в базе — timestamptz, asyncpg отдает его с часовым поясом
+        assert created_at is None or created_at.tzinfo is not None
+        payment_id = len(self.rows) + 1
+        self.rows[payment_id] = {
+            "id": payment_id,
+            "invoice_id": invoice_id,
+            "telegram_id": telegram_id,
+            "status": "pending",
+            "created_at": created_at or datetime.now(timezone.utc),
+        }
+        return payment_id
+
+    def status(self, payment_id: int) -> str:
+        return self.rows[payment_id]["status"]
+
+    def _pending(self) -> list[dict]:
+        return [row for row in self.rows.values() if row["status"] == "pending"]
+
+    async def activate(self, payment_id: int) -> int | None:
+        await asyncio.sleep(0)  # запрос к базе: даем другим задачам вклиниться
+        row = self.rows.get(payment_id)
+        if row is None or row["status"] != "pending":
+            return None
+        row["status"] = "success"
+        return row["telegram_id"]
+
+    # Запросы payment_service к db, которые нужны опросу и вебхуку
+    async def fetchrow(self, query: str, *args):
+        if "invoice_id = ANY" in query:
+            return next((row for row in self._pending() if row["invoice_id"] in args[0]), None)
+        raise AssertionError(f"Неожиданный запрос: {query}")
+
+    async def fetch(self, query: str, *args):
+        if "status='pending'" in query:
+            stale_before = datetime.now(timezone.utc) - timedelta(hours=args[0])
+            return [
+                {**row, "stale": row["created_at"] < stale_before}
+                for row in sorted(self._pending(), key=lambda row: row["created_at"])
+            ]
+        raise AssertionError(f"Неожиданный запрос: {query}")
+
+    async def execute(self, query: str, *args):
+        if "status='expired'" in query and "id = ANY" in query:
+            expired = [row for row in self._pending() if row["id"] in args[0]]
+        else:
+            raise AssertionError(f"Неожиданный запрос: {query}")
+        for row in expired:
+            row["status"] = "expired"
+        return f"UPDATE {len(expired)}"
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent: list[tuple[int, str]] = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.sent.append((chat_id, text))
@@ -0,0 +1,169 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from aiohttp import web
+
+from aiogptbot.bot.config import settings
+from aiogptbot.bot.services import cryptocloud_webhook, payment_service
+from aiogptbot.bot.services.cryptocloud_webhook import verify_postback_token, setup_cryptocloud_routes
+from .fake_cryptocloud import FakeBot, FakeCryptoCloud, FakePayments, sign_postback_token
+
+SECRET = "test-secret"
+PATH = settings.CRYPTOCLOUD_WEBHOOK_PATH
+
+
+@pytest.fixture
+def payments(monkeypatch):
+    store = FakePayments()
+    monkeypatch.setattr(payment_service, "db", store)
+    monkeypatch.setattr(payment_service, "activate_cryptocloud_payment", store.activate)
+    monkeypatch.setattr(payment_service, "_invoice_backoff", {})
+    return store
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    monkeypatch.setattr(settings, "CRYPTOCLOUD_SECRET_KEY", SECRET)
+    return SECRET
+
+
+@pytest.fixture
+async def webhook(aiohttp_client, bot, payments):
+    app = web.Application()
+    setup_cryptocloud_routes(app, bot)
+    return await aiohttp_client(app)
+
+
+@pytest.fixture
+async def cryptocloud(aiohttp_server, monkeypatch):
+    fake = FakeCryptoCloud()
+    server = await aiohttp_server(fake.create_app())
+    client = httpx.AsyncClient(base_url=str(server.make_url("")))
+    monkeypatch.setattr(payment_service, "_http_client", client)
+    yield fake
+    await client.aclose()
+
+
+def postback(invoice_id: str, token: str, status: str = "success") -> dict:
+    return {"status": status, "invoice_id": invoice_id, "token": token}
+
+
+def test_verify_postback_token():
+    token = sign_postback_token("INV-ABC", SECRET)
+    assert verify_postback_token(token, SECRET)["id"] == "INV-ABC"
+    assert verify_postback_token(token, "other-secret") is None
+    assert verify_postback_token(sign_postback_token("INV-ABC", SECRET, ttl=-10), SECRET) is None
+    assert verify_postback_token("not-a-jwt", SECRET) is None
+
+
+async def test_postback_activates_once(webhook, payments, bot, secret):
+    payment_id = payments.add("INV-ABC", telegram_id=42)
+    token = sign_postback_token("INV-ABC", secret)
+
+    for _ in range(2):  # CryptoCloud повторяет постбэк, если не получил ответ вовремя
+        resp = await webhook.post(PATH, json=postback("ABC", token))
+        assert resp.status == 200
+
+    assert payments.status(payment_id) == "success"
+    assert [chat_id for chat_id, _ in bot.sent] == [42]
+
+
+async def test_form_encoded_postback(webhook, payments, bot, secret):
+    payment_id = payments.add("INV-ABC", telegram_id=42)
+    resp = await webhook.post(PATH, data=postback("ABC", sign_postback_token("ABC", secret)))
+    assert resp.status == 200
+    assert payments.status(payment_id) == "success"
+
+
+async def test_bad_signature_rejected(webhook, payments, bot, secret):
+    payment_id = payments.add("INV-ABC", telegram_id=42)
+    resp = await webhook.post(PATH, json=postback("ABC", sign_postback_token("INV-ABC", "forged")))
+    assert resp.status == 401
+    assert payments.status(payment_id) == "pending"
+    assert bot.sent == []
+
+
+async def test_token_for_another_invoice_rejected(webhook, payments, bot, secret):
+    paid_token = sign_postback_token("INV-PAID", secret)
+    payment_id = payments.add("INV-OTHER", telegram_id=42)
+    resp = await webhook.post(PATH, json=postback("OTHER", paid_token))
+    assert resp.status == 401
+    assert payments.status(payment_id) == "pending"
+
+
+async def test_empty_secret_rejects_everything(webhook, payments, bot, monkeypatch):
+    monkeypatch.setattr(settings, "CRYPTOCLOUD_SECRET_KEY", "")
+    payment_id = payments.add("INV-ABC", telegram_id=42)
+    # Токен, подписанный пустым ключом, формально проходит проверку HMAC
+    resp = await webhook.post(PATH, json=postback("ABC", sign_postback_token("INV-ABC", "")))
+    assert resp.status == 401
+    assert payments.status(payment_id) == "pending"
+
+
+async def test_empty_secret_does_not_start_server(bot, monkeypatch):
+    monkeypatch.setattr(settings, "CRYPTOCLOUD_SECRET_KEY", "")
+    await cryptocloud_webhook.start_cryptocloud_webhook(bot)
+    assert cryptocloud_webhook._runner is None
+
+
+@pytest.mark.parametrize("body", ["{not json", "[1, 2]", '"token"'])
+async def test_malformed_body(webhook, secret, body):
+    resp = await webhook.post(PATH, data=body, headers={"Content-Type": "application/json"})
+    assert resp.status == 400
+
+
+async def test_postback_racing_poller(webhook, cryptocloud, payments, bot, secret):
+    payment_id = payments.add("INV-ABC", telegram_id=42)
+    cryptocloud.statuses["INV-ABC"] = "paid"
+    token = sign_postback_token("INV-ABC", secret)
+
+    resp, _ = await asyncio.gather(
+        webhook.post(PATH, json=postback("ABC", token)),
+        payment_service.check_cryptocloud_payments(bot),
+    )
+
+    assert resp.status == 200
+    assert cryptocloud.requests == [["INV-ABC"]]
+    assert payments.status(payment_id) == "success"
+    assert [chat_id for chat_id, _ in bot.sent] == [42]
+
+
+async def test_poller_picks_up_missed_postback(cryptocloud, payments, bot):
+    paid = payments.add("INV-PAID", telegram_id=1)
+    unpaid = payments.add("INV-UNPAID", telegram_id=2)
+    canceled = payments.add("INV-CANCELED", telegram_id=3)
+    cryptocloud.statuses.update({"INV-PAID": "paid", "INV-UNPAID": "created", "INV-CANCELED": "canceled"})
+
+    await payment_service.check_cryptocloud_payments(bot)
+
+    assert (payments.status(paid), payments.status(unpaid), payments.status(canceled)) == ("success", "pending", "expired")
+    assert [chat_id for chat_id, _ in bot.sent] == [1]
+    # Неоплаченный счет отложен: следующий проход его не запрашивает
+    assert payment_service._invoice_backoff["INV-UNPAID"][0] > time.monotonic()
+    await payment_service.check_cryptocloud_payments(bot)
+    assert len(cryptocloud.requests) == 1
+
+
+async def test_stale_invoice_checked_before_expiring(cryptocloud, payments, bot):
+    old = datetime.now(timezone.utc) - timedelta(hours=settings.CRYPTOCLOUD_INVOICE_TTL_HOURS + 1)
+    paid = payments.add("INV-PAID", telegram_id=1, created_at=old)
+    unpaid = payments.add("INV-UNPAID", telegram_id=2, created_at=old)
+    unknown = payments.add("INV-UNKNOWN", telegram_id=3, created_at=old)
+    cryptocloud.statuses.update({"INV-PAID": "paid", "INV-UNPAID": "created"})
+
+    await payment_service.check_cryptocloud_payments(bot)
+
+    # Оплаченный перед самым сроком счет активируется, а не закрывается
+    assert payments.status(paid) == "success"
+    assert payments.status(unpaid) == "expired"
+    # Без ответа CryptoCloud счет не закрывается
+    assert payments.status(unknown) == "pending"
+    assert [chat_id for chat_id, _ in bot.sent] == [1]